@@ -71,18 +71,28 @@ def from_x0_pred_to_xnature_pred_vp_to_vp(x0_pred, noisy_input, current_sigma, d
     noise_coeff = ambient_sqrt(desired_sigma ** 2 - (scaling_coeff ** 2) * current_sigma ** 2)
     return ((noise_coeff / desired_sigma) ** 2 * (ambient_sqrt(1 - desired_sigma ** 2) * x0_pred - noisy_input) + noisy_input) / scaling_coeff
 
+def from_noise_pred_to_xnature_pred_vp_to_vp(noisy_input, noise_pred, current_sigma, desired_sigma):
+    """ from_noise_pred_to_x0_pred_vp followed by from_x0_pred_to_xnature_pred_vp_to_vp, with x0_pred substituted in.
+        sqrt(1 - desired_sigma ** 2) * x0_pred is noisy_input - desired_sigma * noise_pred, so x0_pred is never formed.
+    """
+    current_sigma, desired_sigma = [broadcast_batch_tensor(x) for x in [current_sigma, desired_sigma]]
+    scaling_coeff = ambient_sqrt((1 - desired_sigma**2) / (1 - current_sigma ** 2))
+    noise_coeff = ambient_sqrt(desired_sigma ** 2 - (scaling_coeff ** 2) * current_sigma ** 2)
+    return (noisy_input - (noise_coeff ** 2 / desired_sigma) * noise_pred) / scaling_coeff
+
 def from_x0_pred_to_xnature_pred_ve_to_ve(x0_pred, noisy_input, current_sigma, desired_sigma):
     current_sigma, desired_sigma = [broadcast_batch_tensor(x) for x in [current_sigma, desired_sigma]]
     return (current_sigma ** 2 - desired_sigma ** 2) / (current_sigma ** 2) * x0_pred + (desired_sigma ** 2 / current_sigma ** 2) * noisy_input
 
 
-def add_extra_noise_from_vp_to_vp(noisy_input, current_sigma, desired_sigma):
+def add_extra_noise_from_vp_to_vp(noisy_input, current_sigma, desired_sigma, noise_realization=None):
     """
         Adds extra noise to the input to move from current_sigma to desired_sigma.
         Args:
             noisy_input: input to add noise to
             current_sigma: current noise level
             desired_sigma: desired noise level
+            noise_realization: pre-drawn standard normal noise shaped like noisy_input; drawn here if None
         Returns:
             extra_noisy: noisy input with extra noise
             noise_realization: the noise realization that was added
@@ -90,7 +100,8 @@ def add_extra_noise_from_vp_to_vp(noisy_input, current_sigma, desired_sigma):
     """
     scaling_coeff = ambient_sqrt((1 - desired_sigma**2) / (1 - current_sigma ** 2))
     noise_coeff = ambient_sqrt(desired_sigma ** 2 - (scaling_coeff ** 2) * current_sigma ** 2)
-    noise_realization = torch.randn_like(noisy_input)
+    if noise_realization is None:
+        noise_realization = torch.randn_like(noisy_input)
     scaling_coeff, noise_coeff, current_sigma, desired_sigma = [broadcast_batch_tensor(x) for x in [scaling_coeff, noise_coeff, current_sigma, desired_sigma]]
     extra_noisy = scaling_coeff * noisy_input + noise_coeff * noise_realization
     # when we are trying to move to a lower noise level, just do nothing
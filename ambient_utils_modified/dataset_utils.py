@@ -362,6 +362,89 @@ class ImageFolderDataset(Dataset):
     
 
 
+#----------------------------------------------------------------------------
+# Dataset subclass that serves images from a single uint8 NCHW .npy file,
+# memory-mapped so that no per-image decode happens at load time.
+
+class NumpyMemmapDataset(Dataset):
+    def __init__(self,
+        path,                   # Path to a .npy file of shape NCHW and dtype uint8.
+        resolution      = None, # Ensure specific resolution, None = whatever is stored.
+        **super_kwargs,         # Additional arguments for the Dataset base class.
+    ):
+        self._path = path
+        self._data = None
+
+        raw_shape = list(self._get_data().shape)
+        if self._get_data().dtype != np.uint8 or len(raw_shape) != 4:
+            raise IOError('Memmap file must hold a uint8 array of shape NCHW')
+        if resolution is not None and (raw_shape[2] != resolution or raw_shape[3] != resolution):
+            raise IOError('Memmap images do not match the specified resolution')
+        self._image_fnames = [f'{idx:08d}.png' for idx in range(raw_shape[0])]
+
+        name = os.path.splitext(os.path.basename(self._path))[0]
+        super().__init__(name=name, raw_shape=raw_shape, **super_kwargs)
+
+    def _get_data(self):
+        # opened lazily so that DataLoader workers map the file themselves instead of pickling it
+        if self._data is None:
+            self._data = np.load(self._path, mmap_mode='r')
+        return self._data
+
+    def close(self):
+        self._data = None
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), _data=None)
+
+    def _load_raw_image(self, raw_idx):
+        return np.asarray(self._get_data()[raw_idx])
+
+    def _load_raw_labels(self):
+        return None
+
+
+def images_to_memmap(image_path, output_path, resolution=None):
+    """ Decodes every image of an image folder (or zip) once and stores them in a single .npy file.
+        Args:
+            image_path: directory or zip understood by ImageFolderDataset.
+            output_path: destination .npy file, loadable by NumpyMemmapDataset.
+            resolution: if set, images are resized to (resolution, resolution) before storing.
+        Returns:
+            output_path
+    """
+    source = ImageFolderDataset(path=image_path, normalize=False)
+    num_channels, height, width = source.image_shape
+    if resolution is not None:
+        height = width = resolution
+    # Staged under a temporary name: an interrupted run must not leave a valid-looking .npy with zeroed rows
+    # at output_path, which callers take as already staged
+    tmp_path = output_path + '.tmp'
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(source), num_channels, height, width))
+    for idx in range(len(source)):
+        fname = source._image_fnames[idx]
+        if resolution is not None and source._file_ext(fname) in ('.jpg', '.jpeg'):
+            # JPEG: draft() makes libjpeg decode directly at 1/2, 1/4 or 1/8 scale, close to the target size.
+            # PNG has no such scaled decode, so it takes the full decode + resize path below.
+            with source._open_file(fname) as f, PIL.Image.open(f) as pil_image:
+                pil_image.draft('RGB' if num_channels == 3 else 'L', (width, height))
+                image = np.array(pil_image.resize((width, height), PIL.Image.BILINEAR))
+            images[idx] = image.reshape(height, width, num_channels).transpose(2, 0, 1) # HWC => CHW
+            continue
+        image = source._load_raw_image(idx) # CHW
+        if image.shape[1:] != (height, width):
+            image = image.transpose(1, 2, 0) # CHW => HWC
+            pil_image = PIL.Image.fromarray(image[:, :, 0] if num_channels == 1 else image)
+            image = np.array(pil_image.resize((width, height), PIL.Image.BILINEAR))
+            image = image.reshape(height, width, num_channels).transpose(2, 0, 1) # HWC => CHW
+        images[idx] = image
+    images.flush()
+    del images
+    os.replace(tmp_path, output_path) # atomic on the same filesystem
+    return output_path
+
+
 #----------------------------------------------------------------------------
 
 def filter_keys(key_set):
@@ -4,35 +4,49 @@ import numpy as np
 import scipy
 from ambient_utils import dist
 from tqdm import tqdm
-from ambient_utils.dataset_utils import ImageFolderDataset
+from ambient_utils.dataset_utils import ImageFolderDataset, NumpyMemmapDataset
 import sys
 import os
 import pickle
 from ambient_utils.url_utils import open_url
 
 
+# Inception-v3 detectors already loaded, keyed by device, so repeated FID evaluations in one process
+# (e.g. during training) load the weights only once.
+_DETECTORS = {}
+
+
+def load_detector(device=torch.device('cuda')):
+    # Load Inception-v3 model.
+    # This is a direct PyTorch translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
+    key = str(device)
+    if key not in _DETECTORS:
+        detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
+        # hack to add torch utils to path
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        sys.path.append(dir_path)
+        dist.print0("Loading detector")
+        with open_url(detector_url, verbose=(dist.get_rank() == 0)) as f:
+            _DETECTORS[key] = pickle.load(f).to(device)
+        dist.print0("Detector loaded.")
+    return _DETECTORS[key]
+
+
 def calculate_inception_stats(
     image_path, num_expected=None, seed=0, max_batch_size=64,
     num_workers=3, prefetch_factor=2, device=torch.device('cuda'), 
     distributed=False):
 
-    # Load Inception-v3 model.
-    # This is a direct PyTorch translation of http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz
-    detector_url = 'https://api.ngc.nvidia.com/v2/models/nvidia/research/stylegan3/versions/1/files/metrics/inception-2015-12-05.pkl'
     detector_kwargs = dict(return_features=True)
     inception_kwargs = dict(no_output_bias=True) # Match the original implementation by not applying bias in the softmax layer.
     feature_dim = 2048
-    
-    # hack to add torch utils to path
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    sys.path.append(dir_path)
-    dist.print0("Loading detector")
-    with open_url(detector_url, verbose=(dist.get_rank() == 0)) as f:
-        detector_net = pickle.load(f).to(device)
-    dist.print0("Detector loaded.")
-
-    # List images.
-    dataset_obj = ImageFolderDataset(path=image_path, max_size=num_expected, random_seed=seed, normalize=False)
+    detector_net = load_detector(device)
+
+    # List images. A .npy file produced by dataset_utils.images_to_memmap skips the per-image decode.
+    if image_path.endswith('.npy'):
+        dataset_obj = NumpyMemmapDataset(path=image_path, max_size=num_expected, random_seed=seed, normalize=False)
+    else:
+        dataset_obj = ImageFolderDataset(path=image_path, max_size=num_expected, random_seed=seed, normalize=False)
 
     # Other ranks follow.
     if distributed and dist.get_rank() == 0:
@@ -13,10 +13,11 @@ def compute_fid_stats(image_dir, output_path):
 
     # Move the stats file to the desired output path
     stats_file = os.path.join(stats_src_path, "fid_stats_ffhq1024.npz")
-    if os.path.exists(stats_file):
-        os.rename(stats_file, output_path)
+    # os.replace is atomic on the same filesystem and overwrites stats from a previous run
+    try:
+        os.replace(stats_file, output_path)
         print(f"FID statistics saved to: {output_path}")
-    else:
+    except FileNotFoundError:
         print("Error: FID statistics file was not created.")
 
 compute_fid_stats(image_dir, stats_output_path)
@@ -38,18 +38,18 @@ def main(args):
 
     os.makedirs(args.output_dir, exist_ok=True)
     results = {}
-    for model_index, (model_key, model_dict) in enumerate(models.items()):
+    for model_index, (model_key, model_cfg) in enumerate(models.items()):
         print("Working with model: ", model_key)
-        if model_dict['ckpt_path'] is not None:
+        if model_cfg.ckpt_path is not None:
             # get latest checkpoint
-            checkpoint_numbers = [int(f.split('-')[-1]) for f in os.listdir(model_dict['ckpt_path']) if "checkpoint-" in f]
+            checkpoint_numbers = [int(f.split('-')[-1]) for f in os.listdir(model_cfg.ckpt_path) if "checkpoint-" in f]
             max_number = str(sorted(checkpoint_numbers)[-1]).zfill(6)
-            ckpt_path = os.path.join(model_dict['ckpt_path'], "checkpoint-" + max_number)
+            ckpt_path = os.path.join(model_cfg.ckpt_path, "checkpoint-" + max_number)
             print("Loading model from checkpoint: ", ckpt_path)
         else:
             ckpt_path = None
         pipe = ambient_utils.diffusers_utils.load_model(ckpt_path, vae_path="madebyollin/sdxl-vae-fp16-fix", sdxl_path="stabilityai/stable-diffusion-xl-base-1.0", 
-                          trained_with_lora=model_dict['trained_with_lora']).to("cuda")
+                          trained_with_lora=model_cfg.trained_with_lora).to("cuda")
         latent_errors = defaultdict(list)
         errors = defaultdict(list)
         for dataset_item in dataset_obj:
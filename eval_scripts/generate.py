@@ -56,9 +56,9 @@ def main(args):
     if args.captions_loc is not None:
         captions = list(load_captions(args.captions_loc).values())
     if args.model_key is not None:
-        args.ckpt_path = models[args.model_key]["ckpt_path"]
-        args.trained_with_lora = models[args.model_key]["trained_with_lora"]
-        args.timestep_nature = models[args.model_key]["timestep_nature"]
+        args.ckpt_path = models[args.model_key].ckpt_path
+        args.trained_with_lora = models[args.model_key].trained_with_lora
+        args.timestep_nature = models[args.model_key].timestep_nature
     else:
         if args.ckpt_path is None:
             warnings.warn("No model key or checkpoint path provided, using SDXL model.")
@@ -1,7 +1,64 @@
 import os
-import imageio
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
-import numpy as np
+
+
+def _load_font():
+    # Load a font (adjust the path to a TTF file if needed)
+    try:
+        return ImageFont.truetype("arial.ttf", 100)  # Adjusted font size for smaller images
+    except OSError:
+        return ImageFont.load_default()
+
+
+# FreeType face init is not free, so the font is loaded once at import time
+FONT = _load_font()
+
+
+def _fixed_palette():
+    # Uniform 4x4x4 RGB cube: 64 colors that include pure black and white for the step label
+    levels = (0, 85, 170, 255)
+    palette_img = Image.new("P", (1, 1))
+    palette_img.putpalette([c for r in levels for g in levels for b in levels for c in (r, g, b)])
+    return palette_img
+
+
+# Shared by every frame, so no per-frame palette has to be solved
+GIF_PALETTE = _fixed_palette()
+
+
+def _decode_and_resize(job):
+    """Decode and downscale one validation image. PIL releases the GIL here, so this runs in worker threads."""
+    i, subdir_idx, image_path = job
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")  # Ensure image is in RGB mode
+
+        # Resize the image to reduce size. Validation images are 1024x1024, an exact 8x ratio,
+        # for which reduce() is a dedicated box-average path; anything else falls back to BOX.
+        factor = img.width // 128
+        if factor > 1 and img.size == (128 * factor, 128 * factor):
+            img = img.reduce(factor)
+        else:
+            img = img.resize((128, 128), Image.Resampling.BOX)
+    return i, subdir_idx, img
+
+
+def _render_label(step_number):
+    """Rasterize the step label once, on the black background box drawn behind it."""
+    # The font measures the text itself; no scratch image or ImageDraw context is needed for that
+    text_width, text_height = FONT.getbbox(step_number)[2:]
+    label = Image.new("RGB", (text_width + 1, text_height + 1), "black")  # Add background for visibility
+    ImageDraw.Draw(label).text((0, 0), step_number, fill="white", font=FONT)  # Draw the text
+    return label
+
+
+def _save_gif(job):
+    output_gif_path, frames = job
+    # An explicit format skips Pillow's extension-based plugin lookup
+    frames[0].save(output_gif_path, format="GIF", save_all=True, append_images=frames[1:],
+                   duration=500, loop=0, disposal=2, optimize=False)
+    return output_gif_path
+
 
 def create_gifs(validation_images_dir, output_gifs_dir):
     # Ensure output directory exists
@@ -9,54 +66,43 @@ def create_gifs(validation_images_dir, output_gifs_dir):
 
     try:
         # Get all subdirectories sorted by numerical order
-        subdirs = sorted(
-            [d for d in os.listdir(validation_images_dir) if os.path.isdir(os.path.join(validation_images_dir, d))],
-            key=lambda x: int(x)
-        )
+        # DirEntry.is_dir() reuses the type returned by the directory scan instead of a stat per child
+        with os.scandir(validation_images_dir) as entries:
+            subdirs = sorted([entry.name for entry in entries if entry.is_dir()], key=lambda x: int(x))
         print(f"Found subdirectories: {subdirs}")
 
-        # Initialize a dictionary to store images for each frame
-        frames = {i: [] for i in range(4)}
-
-        for subdir in subdirs:
+        # Collect the decode jobs and the per-subdir labels up front
+        jobs = []
+        labels = []
+        for subdir_idx, subdir in enumerate(subdirs):
             subdir_path = os.path.join(validation_images_dir, subdir)
             images = sorted([img for img in os.listdir(subdir_path) if img.endswith('.png')])[:4]  # Limit to first 4 images
             print(f"Processing folder {subdir}: found images {images}")
 
-            for i, image in enumerate(images):
-                image_path = os.path.join(subdir_path, image)
-
-                # Open image using Pillow to add text
-                with Image.open(image_path) as img:
-                    img = img.convert("RGB")  # Ensure image is in RGB mode
-
-                    # Resize the image to reduce size (e.g., 512x512)
-                    img = img.resize((128, 128), Image.Resampling.LANCZOS)
-
-                    draw = ImageDraw.Draw(img)
+            # The label only depends on the subdir, so rasterize it once for all of its frames
+            labels.append(_render_label(f"Step {subdir}"))
 
-                    # Load a font (adjust the path to a TTF file if needed)
-                    try:
-                        font = ImageFont.truetype("arial.ttf", 100)  # Adjusted font size for smaller images
-                    except:
-                        font = ImageFont.load_default()
+            jobs.extend((i, subdir_idx, os.path.join(subdir_path, image)) for i, image in enumerate(images))
 
-                    # Add the step number (directory number) at the top left corner
-                    step_number = f"Step {subdir}"
-                    text_width, text_height = draw.textbbox((0, 0), step_number, font=font)[2:]  # Updated to use textbbox
-                    draw.rectangle((20, 20, 20 + text_width, 20 + text_height), fill="black")  # Add background for visibility
-                    draw.text((20, 20), step_number, fill="white", font=font)  # Draw the text
+        # Quantize each frame against the fixed palette as it arrives. Paletted 128x128 frames are
+        # 16 KB each, so holding them until the GIFs are written stays small.
+        p_frames = [[] for _ in range(4)]
 
-                    # Convert back to numpy array for imageio
-                    frames[i].append(np.array(img))
+        # Decode in background threads while the main thread annotates; map keeps the subdir order
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for i, subdir_idx, img in executor.map(_decode_and_resize, jobs):
+                # Add the step number (directory number) at the top left corner. paste() clips to the
+                # frame and keeps everything in PIL, so there is no PIL <-> NumPy round trip per frame.
+                img.paste(labels[subdir_idx], (20, 20))
 
-        # Create GIFs for each frame
-        for i in range(4):
-            output_gif_path = os.path.join(output_gifs_dir, f"{i:06d}.gif")
+                p_frames[i].append(img.quantize(palette=GIF_PALETTE, dither=Image.Dither.FLOYDSTEINBERG))
 
-            # Optimize GIF size by reducing quality and using fewer colors
-            imageio.mimsave(output_gif_path, frames[i], duration=0.5, quantize=256, palettesize=64)
-            print(f"Saved GIF: {output_gif_path}")
+        # Create GIFs for each frame. The four GIFs are independent and Pillow's LZW encoder runs in C,
+        # so they are encoded concurrently.
+        gif_jobs = [(os.path.join(output_gifs_dir, f"{i:06d}.gif"), p_frames[i]) for i in range(4) if p_frames[i]]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for output_gif_path in executor.map(_save_gif, gif_jobs):
+                print(f"Saved GIF: {output_gif_path}")
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -17,6 +17,8 @@
 
 import warnings
 import argparse
+import collections
+import contextlib
 import logging
 import math
 import os
@@ -30,19 +32,23 @@ import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
 import transformers
+from concurrent.futures import ThreadPoolExecutor
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
+from accelerate.utils import DataLoaderConfiguration, DistributedDataParallelKwargs, ProjectConfiguration, set_seed
+from datasets import Image as ImageFeature
 from datasets import load_dataset
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
 from peft import LoraConfig
 from peft.utils import get_peft_model_state_dict
-from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_image, read_file
+from torchvision.transforms import v2
 from torchvision.transforms.functional import crop
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer, PretrainedConfig
 import functools
+import itertools
 import ambient_utils
 import diffusers
 from diffusers import (
@@ -52,11 +58,13 @@ from diffusers import (
     UNet2DConditionModel,
 )
 from diffusers.loaders import LoraLoaderMixin
+from diffusers.models.attention_processor import AttnProcessor2_0
 from diffusers.optimization import get_scheduler
-from diffusers.training_utils import cast_training_params, compute_snr
+from diffusers.training_utils import cast_training_params
 from diffusers.utils import check_min_version, convert_state_dict_to_diffusers, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
 from diffusers.utils.torch_utils import is_compiled_module
+import io
 import time
 from ambient_utils.eval_utils import calculate_inception_stats, calculate_fid_from_inception_stats
 import PIL
@@ -291,8 +299,13 @@ def parse_args(input_args=None):
     )
     parser.add_argument(
         "--gradient_checkpointing",
-        action="store_true",
-        help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help=(
+            "Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass."
+            " Enabled by default; the freed activation memory allows larger batches. Disable with"
+            " `--no-gradient_checkpointing`."
+        ),
     )
     parser.add_argument(
         "--learning_rate",
@@ -336,13 +349,26 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--dataloader_num_workers",
         type=int,
-        default=0,
+        default=4,
         help=(
             "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
         ),
     )
     parser.add_argument(
-        "--use_8bit_adam", action="store_true", help="Whether or not to use 8-bit Adam from bitsandbytes."
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=4,
+        help="Number of batches loaded in advance by each dataloader worker. Ignored when there are no workers.",
+    )
+    parser.add_argument(
+        "--use_8bit_adam", action="store_true", help="Whether or not to use the paged AdamW from bitsandbytes."
+    )
+    parser.add_argument(
+        "--optim_bits",
+        type=int,
+        default=8,
+        choices=[8, 32],
+        help="Precision of the bitsandbytes AdamW optimizer states when `--use_8bit_adam` is set.",
     )
     parser.add_argument('--with_grad', default=True, type=bool, help='Enable gradient computation')
     parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
@@ -395,6 +421,100 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
     )
+    parser.add_argument(
+        "--use_sdpa",
+        action="store_true",
+        help=(
+            "Whether or not to route the UNet attention through PyTorch's `scaled_dot_product_attention`"
+            " (`AttnProcessor2_0`) instead of xformers. Composes with `--compile_unet` without graph breaks."
+        ),
+    )
+    parser.add_argument(
+        "--vae_dtype",
+        type=str,
+        default=None,
+        choices=["fp32", "fp16", "bf16"],
+        help=(
+            "The dtype of the VAE. Defaults to bf16 when training with bf16 mixed precision. Otherwise the VAE is"
+            " kept in fp32 (the default SDXL VAE produces NaNs in fp16), or in the weight dtype when"
+            " `--pretrained_vae_model_name_or_path` is set."
+        ),
+    )
+    parser.add_argument(
+        "--compile_unet",
+        action="store_true",
+        help=(
+            "Whether or not to wrap the UNet with `torch.compile(mode='reduce-overhead')`. Every UNet call of the"
+            " training step, including the consistency rollouts, runs through the compiled module."
+            " Requires PyTorch >= 2.1."
+        ),
+    )
+    parser.add_argument(
+        "--compile_vae",
+        action="store_true",
+        help=(
+            "Whether or not to wrap `vae.encode` with `torch.compile(mode='reduce-overhead')` for the latent"
+            " pre-computation pass. Requires PyTorch >= 2.0."
+        ),
+    )
+    parser.add_argument(
+        "--compile_text_encoder",
+        action="store_true",
+        help=(
+            "Whether or not to `torch.compile` the per-step text encoding. With `--train_text_encoder` both encoders"
+            " are wrapped with `mode='reduce-overhead'`; with frozen encoders the whole `encode_prompt` call of the"
+            " training step is compiled instead. Prompts are padded to `tokenizer.model_max_length`, so the shapes"
+            " are static. Requires PyTorch >= 2.0."
+        ),
+    )
+    parser.add_argument(
+        "--compile_step_fns",
+        action="store_true",
+        help=(
+            "Whether or not to `torch.compile` the small element-wise helpers run on every step (e.g. the timestep"
+            " curriculum and the masked loss), fusing their kernels into one launch. Requires PyTorch >= 2.0."
+        ),
+    )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        help=(
+            "Whether or not to hold the pre-computed VAE latents in CPU memory as fp16 instead of reading"
+            " them back from the dataset cache on every step. With `--random_flip`, the latents of the flipped"
+            " images are cached as well."
+        ),
+    )
+    parser.add_argument(
+        "--cache_latents_on_gpu",
+        action="store_true",
+        help=(
+            "With `--cache_latents`, hold the cached latents on the training device instead of in CPU memory,"
+            " so no host-to-device copy is made per step. Requires `--dataloader_num_workers 0`."
+        ),
+    )
+    parser.add_argument(
+        "--cache_text_embeddings",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help=(
+            "Whether or not to run both text encoders once over the captions and serve the prompt embeddings, in the"
+            " training dtype, from CPU memory instead of calling `encode_prompt` on every step. Defaults to on whenever the"
+            " text encoders are frozen, i.e. without `--train_text_encoder`; disable with"
+            " `--no-cache_text_embeddings`."
+        ),
+    )
+    parser.add_argument(
+        "--group_by_caption_length",
+        action="store_true",
+        help=(
+            "Whether or not to batch captions of similar token length together and trim each batch's token ids to"
+            " its longest caption, so the per-step text encoder pass runs on less padding. Only useful when the"
+            " prompt embeddings are computed every step, i.e. with `--train_text_encoder`. Note that the UNet then"
+            " cross-attends to fewer than `tokenizer.model_max_length` (77) text tokens, while `StableDiffusionXLPipeline`"
+            " (validation, FID and inference) always conditions on all 77 padded tokens, so training and inference see"
+            " different attention distributions. The padded positions cannot be restored exactly without encoding them."
+        ),
+    )
     parser.add_argument("--noise_offset", type=float, default=0, help="The scale of noise offset.")
     parser.add_argument(
         "--rank",
@@ -410,6 +530,12 @@ def parse_args(input_args=None):
     parser.add_argument("--consistency_coeff", type=float, default=0.0, help="The coefficient of the consistency loss.")
     parser.add_argument("--max_steps_diff", type=int, default=None, help="The maximum number of steps difference for consistency.")
     parser.add_argument("--num_consistency_steps", type=int, default=1, help="The number of consistency steps.")
+    parser.add_argument("--checkpoint_rollout", action="store_true", default=False,
+                        help="Whether to recompute the UNet forwards of the consistency rollout in the backward pass instead of keeping their activations (only matters with `--with_grad`).")
+    parser.add_argument("--detach_rollout", action="store_true", default=False,
+                        help="Whether to run the consistency rollout after its first step without gradients and detach the iterates before the final predictions. With `--with_grad` the boundary prediction of the first step keeps its gradient; the final predictions always do.")
+    parser.add_argument("--ac_budget", type=float, default=None,
+                        help="Activation memory budget in [0, 1]. With `--compile_unet` it is handed to the partitioner (1.0 keeps every activation, lower values recompute more, cheapest pointwise ops first). In eager mode, a budget above 0 makes `--checkpoint_rollout` keep the matmul, convolution and attention outputs and recompute only the pointwise ops; 0 recomputes everything.")
     parser.add_argument("--x0_pred", action="store_true", help="Whether to train with x0 prediction.", default=False)
 
     # SLURM related
@@ -445,6 +571,24 @@ def parse_args(input_args=None):
     # Sanity checks
     if args.dataset_name is None and args.train_data_dir is None:
         raise ValueError("Need either a dataset name or a training folder.")
+    if args.cache_text_embeddings is None:
+        # Frozen text encoders produce the same embeddings for a caption on every epoch
+        args.cache_text_embeddings = not args.train_text_encoder
+    elif args.cache_text_embeddings and args.train_text_encoder:
+        raise ValueError("`--cache_text_embeddings` cannot be used together with `--train_text_encoder`.")
+    if args.cache_latents_on_gpu and not args.cache_latents:
+        raise ValueError("`--cache_latents_on_gpu` requires `--cache_latents`.")
+    if args.cache_latents_on_gpu and args.dataloader_num_workers > 0:
+        raise ValueError("`--cache_latents_on_gpu` requires `--dataloader_num_workers 0`; CUDA tensors cannot be shared with worker processes.")
+    if args.ac_budget is not None:
+        if not 0.0 <= args.ac_budget <= 1.0:
+            raise ValueError(f"`--ac_budget` must be in [0, 1], got {args.ac_budget}.")
+        if not (args.compile_unet or args.checkpoint_rollout):
+            raise ValueError("`--ac_budget` requires `--compile_unet` or `--checkpoint_rollout`.")
+    if args.group_by_caption_length and args.cache_text_embeddings:
+        raise ValueError("`--group_by_caption_length` has no effect with cached text embeddings; pass `--no-cache_text_embeddings`.")
+    if args.group_by_caption_length and args.compile_text_encoder:
+        raise ValueError("`--group_by_caption_length` varies the prompt length per batch; `--compile_text_encoder` compiles for static shapes.")
 
     return args
 
@@ -466,6 +610,11 @@ def tokenize_prompt(tokenizer, prompt):
     return text_input_ids
 
 
+# Output buffers of `encode_prompt` for frozen text encoders, keyed by batch size, embedding width, device and dtype.
+# Each is flat and sized for the longest prompt seen, so varying prompt lengths share one buffer.
+PROMPT_EMBEDS_BUFFERS = {}
+
+
 # Adapted from pipelines.StableDiffusionXLPipeline.encode_prompt
 def encode_prompt(text_encoders, tokenizers, prompt, text_input_ids_list=None):
     prompt_embeds_list = []
@@ -479,7 +628,7 @@ def encode_prompt(text_encoders, tokenizers, prompt, text_input_ids_list=None):
             text_input_ids = text_input_ids_list[i]
 
         prompt_embeds = text_encoder(
-            text_input_ids.to(text_encoder.device), output_hidden_states=True, return_dict=False
+            text_input_ids.to(text_encoder.device, non_blocking=True), output_hidden_states=True, return_dict=False
         )
 
         # We are only ALWAYS interested in the pooled output of the final text encoder
@@ -489,23 +638,344 @@ def encode_prompt(text_encoders, tokenizers, prompt, text_input_ids_list=None):
         prompt_embeds = prompt_embeds.view(bs_embed, seq_len, -1)
         prompt_embeds_list.append(prompt_embeds)
 
-    prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+    if any(embeds.requires_grad for embeds in prompt_embeds_list):
+        # Trained text encoders: autograd needs a fresh tensor on every call
+        prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+    else:
+        # Frozen text encoders: write both hidden states into a buffer that is reused across calls
+        # instead of allocating a new [bs, seq_len, 768 + 1280] tensor every step
+        embed_dim = sum(embeds.shape[-1] for embeds in prompt_embeds_list)
+        key = (bs_embed, embed_dim, prompt_embeds.device, prompt_embeds.dtype)
+        numel = bs_embed * seq_len * embed_dim
+        buffer = PROMPT_EMBEDS_BUFFERS.get(key)
+        if buffer is None or buffer.numel() < numel:
+            # Replaces (and frees) a buffer sized for a shorter prompt
+            buffer = torch.empty(numel, device=prompt_embeds.device, dtype=prompt_embeds.dtype)
+            PROMPT_EMBEDS_BUFFERS[key] = buffer
+        # The leading `numel` elements viewed as [bs, seq_len, dim] are contiguous, as `out=` needs
+        prompt_embeds = torch.concat(
+            prompt_embeds_list, dim=-1, out=buffer[:numel].view(bs_embed, seq_len, embed_dim)
+        )
     pooled_prompt_embeds = pooled_prompt_embeds.view(bs_embed, -1)
     return prompt_embeds, pooled_prompt_embeds
 
 
-def compute_vae_encodings(batch, vae, noise_scheduler):
+def vae_encode_overlapped(vae, pixel_values, chunk_size, generator=None, flipped=False):
+    """Encode a pinned CPU batch in chunks of `chunk_size`, uploading the next chunk on a side stream while the
+    current one is encoded. Returns the scaled latents and, if `flipped`, those of the horizontally flipped images.
+    """
+
+    def upload(chunk):
+        # One non-blocking copy that also casts to the VAE dtype / layout
+        return chunk.to(vae.device, dtype=vae.dtype, non_blocking=True, memory_format=torch.channels_last)
+
+    chunks = pixel_values.split(chunk_size)
+    overlap = vae.device.type == "cuda" and len(chunks) > 1
+    if overlap:
+        copy_stream = torch.cuda.Stream(device=vae.device)
+        compute_stream = torch.cuda.current_stream(vae.device)
+        with torch.cuda.stream(copy_stream):
+            next_chunk = upload(chunks[0])
+
+    latents, latents_flipped = [], []
+    for i in range(len(chunks)):
+        if overlap:
+            # Wait for this chunk's upload only, then start the next one behind the encode
+            compute_stream.wait_stream(copy_stream)
+            current = next_chunk
+            current.record_stream(compute_stream)
+            if i + 1 < len(chunks):
+                with torch.cuda.stream(copy_stream):
+                    next_chunk = upload(chunks[i + 1])
+        else:
+            current = upload(chunks[i])
+        latents.append(vae.encode(current).latent_dist.sample(generator=generator))
+        if flipped:
+            latents_flipped.append(vae.encode(torch.flip(current, dims=[-1])).latent_dist.sample(generator=generator))
+
+    model_input = torch.cat(latents) * vae.config.scaling_factor
+    model_input_flipped = torch.cat(latents_flipped) * vae.config.scaling_factor if flipped else None
+    return model_input, model_input_flipped
+
+
+def compute_vae_encodings(batch, vae, noise_scheduler, generator=None, buffers=None, chunk_size=None):
     images = batch.pop("pixel_values")
-    pixel_values = torch.stack(list(images))
-    pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-    pixel_values = pixel_values.to(vae.device, dtype=vae.dtype)
-    with torch.no_grad():
-        model_input = vae.encode(pixel_values).latent_dist.sample()
-    model_input = model_input * vae.config.scaling_factor
-    timesteps = torch.ones(model_input.shape[0], device=model_input.device, dtype=torch.long) * args.timestep_nature
-    if args.noisy_ambient:
-        model_input = noise_scheduler.add_noise(model_input, torch.randn_like(model_input), timesteps)
-    return {"model_input": model_input.cpu()}
+    # Stack straight into a pinned buffer so the host-to-device copies can run asynchronously
+    pixel_values = torch.empty(
+        (len(images), *images[0].shape), dtype=images[0].dtype, pin_memory=torch.cuda.is_available()
+    )
+    torch.stack(list(images), out=pixel_values)
+    with torch.inference_mode():
+        model_input, model_input_flipped = vae_encode_overlapped(
+            vae,
+            pixel_values,
+            chunk_size or len(pixel_values),
+            generator=generator,
+            flipped=args.cache_latents and args.random_flip,
+        )
+        timesteps = torch.ones(model_input.shape[0], device=model_input.device, dtype=torch.long) * args.timestep_nature
+        if args.noisy_ambient:
+            # Refill one persistent buffer instead of allocating a fresh noise tensor for every batch
+            noise = buffers.get("noise") if buffers is not None else None
+            if noise is None or noise.shape != model_input.shape:
+                noise = torch.empty_like(model_input)
+                if buffers is not None:
+                    buffers["noise"] = noise
+            noise.normal_(generator=generator)
+            model_input = noise_scheduler.add_noise(model_input, noise, timesteps)
+            if model_input_flipped is not None:
+                # Mirror the noise as well, so both orientations share one noise realization
+                model_input_flipped = noise_scheduler.add_noise(model_input_flipped, torch.flip(noise, dims=[-1]), timesteps)
+    # No explicit .cpu(): the map copies the tensors to host once, when it writes them to the Arrow cache
+    if model_input_flipped is not None:
+        return {"model_input": model_input, "model_input_flipped": model_input_flipped}
+    return {"model_input": model_input}
+
+
+class CachedTensorsDataset(torch.utils.data.Dataset):
+    """Serves pre-computed per-sample tensors from memory and everything else from the wrapped dataset.
+
+    `tensors` maps a column name to a tensor indexed by sample. `flipped` optionally maps a column name to the
+    tensor computed on the flipped images; it is served instead for a random half of the reads.
+    """
+
+    def __init__(self, dataset, tensors, flipped=None):
+        self.dataset = dataset
+        self.tensors = tensors
+        self.flipped = flipped or {}
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        example = self.dataset[idx]
+        use_flipped = bool(self.flipped) and random.random() < 0.5
+        for column, values in self.tensors.items():
+            if use_flipped and column in self.flipped:
+                values = self.flipped[column]
+            example[column] = values[idx]
+        return example
+
+
+def decode_image_rgb(image):
+    """Decode a dataset image into a uint8 (3, H, W) tensor.
+
+    Undecoded `datasets.Image` entries (`{"bytes", "path"}` dicts) go through torchvision's libjpeg-turbo/libpng
+    decoders straight into a tensor; formats those do not handle, and already decoded PIL images, use PIL.
+    """
+    if isinstance(image, dict):
+        data = image["bytes"]
+        try:
+            if data is None:
+                encoded = read_file(image["path"])
+            else:
+                encoded = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+            return decode_image(encoded, mode=ImageReadMode.RGB)
+        except RuntimeError:
+            image = PIL.Image.open(image["path"] if data is None else io.BytesIO(data))
+    return v2.functional.pil_to_tensor(image.convert("RGB"))
+
+
+class CaptionLengthGroupedBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of indices whose captions have similar token lengths.
+
+    Every epoch the indices are shuffled and cut into mega-batches of `batch_size * mega_batch_mult` samples; each
+    mega-batch is sorted by length and split into batches, and the order of the batches is shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_size = batch_size * mega_batch_mult
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        batches = []
+        for mega_batch in torch.randperm(len(self.lengths)).split(self.mega_batch_size):
+            order = torch.argsort(self.lengths[mega_batch], descending=True)
+            batches.extend(mega_batch[order].split(self.batch_size))
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i].tolist()
+
+
+class StepNoiseBuffers:
+    """Standard normal noise for the training step, refilled in place instead of allocated on every step.
+
+    The buffers are double-buffered: step N fills one slot while the backward of step N - 1 may still read the
+    other. With a side `stream` the fills run there, and a slot is only refilled once the current stream has
+    finished everything queued before the previous draw, i.e. the last step that read it.
+    """
+
+    def __init__(self, num_draws, device, dtype, stream=None):
+        self.num_draws = num_draws
+        self.device = device
+        self.dtype = dtype
+        self.stream = stream
+        self.slots = [None, None]
+        self.released = [None, None]
+        self.slot = 0
+
+    def draw(self, shape, noise_offset=0):
+        """Return `num_draws` tensors of `shape` (channels_last); `noise_offset` is added to the first one."""
+        slot, self.slot = self.slot, self.slot ^ 1
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # Everything queued so far includes the last use of the other slot, by the previous step
+            self.released[slot ^ 1] = current_stream.record_event()
+            if self.released[slot] is not None:
+                self.stream.wait_event(self.released[slot])
+
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            buffers = self.slots[slot]
+            if buffers is None or buffers[0].shape[0] < shape[0] or buffers[0].shape[1:] != shape[1:]:
+                buffers = [
+                    torch.empty(shape, device=self.device, dtype=self.dtype, memory_format=torch.channels_last)
+                    for _ in range(self.num_draws)
+                ]
+                # (B, C, 1, 1) offset noise, see https://www.crosslabs.org//blog/diffusion-with-offset-noise
+                buffers.append(torch.empty((shape[0], shape[1], 1, 1), device=self.device, dtype=self.dtype))
+                self.slots[slot] = buffers
+            # Slicing the batch dimension keeps the channels_last strides, so a short last batch reuses them too
+            draws = [buffer[: shape[0]].normal_() for buffer in buffers[:-1]]
+            if noise_offset:
+                draws[0].add_(buffers[-1][: shape[0]].normal_(), alpha=noise_offset)
+
+        if self.stream is not None:
+            current_stream.wait_stream(self.stream)
+        return draws
+
+
+def randn_channels_last(shape, device, dtype, stream=None):
+    """Standard normal noise of `shape` in channels_last, filled on `stream` when one is given.
+
+    The fill is queued on `stream` without waiting, so it overlaps with the work pending on the current stream;
+    call `torch.cuda.current_stream().wait_stream(stream)` before reading the result.
+    """
+    with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+        noise = torch.empty(shape, device=device, dtype=dtype, memory_format=torch.channels_last).normal_()
+    if stream is not None:
+        # Allocated from the side stream's pool but read (and freed) on the current one
+        noise.record_stream(torch.cuda.current_stream(device))
+    return noise
+
+
+@functools.lru_cache(maxsize=None)
+def load_fid_ref_stats(path):
+    """Read the reference `mu` and `sigma` from `path` once; every later FID evaluation reuses the arrays."""
+    with np.load(path) as ref_data:
+        return ref_data['mu'], ref_data['sigma']
+
+
+def make_rollout_checkpoint_context_fn():
+    """Build a `context_fn` for `torch.utils.checkpoint.checkpoint` that keeps the outputs of the matmul,
+    convolution and attention ops and recomputes everything else (GroupNorm, SiLU, adds, the sigma math).
+
+    Needs PyTorch >= 2.4 for the selective checkpointing API.
+    """
+    from torch.utils.checkpoint import CheckpointPolicy, create_selective_checkpoint_contexts
+
+    aten = torch.ops.aten
+    saved_ops = {aten.mm.default, aten.bmm.default, aten.addmm.default, aten.convolution.default}
+    for name in ("_scaled_dot_product_flash_attention", "_scaled_dot_product_efficient_attention"):
+        if hasattr(aten, name):
+            saved_ops.add(getattr(aten, name).default)
+
+    def policy_fn(ctx, op, *args, **kwargs):
+        return CheckpointPolicy.MUST_SAVE if op in saved_ops else CheckpointPolicy.PREFER_RECOMPUTE
+
+    return functools.partial(create_selective_checkpoint_contexts, policy_fn)
+
+
+def dataloader_worker_init_fn(worker_id):
+    """Give each DataLoader worker one intra-op thread and its own slice of the CPUs the process may use.
+
+    Without this every worker starts a full-size intra-op pool, and they oversubscribe the cores between them.
+    """
+    torch.set_num_threads(1)
+    if hasattr(os, "sched_setaffinity"):
+        num_workers = torch.utils.data.get_worker_info().num_workers
+        cpus = sorted(os.sched_getaffinity(0))
+        worker_cpus = cpus[worker_id::num_workers]
+        if worker_cpus:
+            os.sched_setaffinity(0, worker_cpus)
+
+
+def load_column_cache(dataset, column, device=None, dtype=torch.float16):
+    """Read a tensor column once into a contiguous tensor of `dtype`.
+
+    The tensor is moved to `device` when given, otherwise it stays in ordinary CPU memory: the rows are read from
+    the forked DataLoader workers, and `DataLoader(pin_memory=True)` pins each collated batch.
+    """
+    latents = torch.from_numpy(np.asarray(dataset.with_format("numpy", columns=[column])[column]))
+    latents = latents.to(dtype).contiguous()
+    if device is not None:
+        latents = latents.to(device)
+    return latents
+
+
+def curriculum_adjust_timesteps(initial_timesteps, loss, min_timesteps, max_timesteps, curriculum_factor):
+    """Tensor part of `adjust_timesteps`, kept free of Python-side control flow so it can be compiled.
+
+    `curriculum_factor` is a 0-dim tensor rather than a float, so its per-step value does not trigger recompiles.
+    Returns the adjusted timesteps together with the adjustment and non-linear factors for logging.
+    """
+    # Unconditional clamp: the old `torch.any(...)` guard cost a device-to-host sync on every step
+    loss = torch.clamp(loss, 0.01, 0.6)
+
+    # Check normalization
+    loss_normalized = (loss - 0.01) / (0.6 - 0.01)
+    loss_normalized = torch.clamp(loss_normalized, 0.0, 1.0)
+
+    # Check adjustment factor
+    non_linear_factor = torch.tanh((loss_normalized - 0.5) * 10) + 0.5
+    adjustment_factor = (1 - 2 * loss_normalized) * (1 - curriculum_factor) + non_linear_factor * curriculum_factor
+
+    # Check adjustment
+    adjustment = adjustment_factor * (max_timesteps - min_timesteps) * 0.5 * curriculum_factor
+
+    # Ensure clamped timesteps
+    adjusted_timesteps = torch.clamp((initial_timesteps + adjustment).long(), min=min_timesteps, max=max_timesteps)
+    return adjusted_timesteps, adjustment_factor, non_linear_factor
+
+
+def stochastic_step_coeffs(var_t, var_s):
+    """Coefficients of the one-step stochastic sampler from noise variance `var_t` to `var_s`.
+
+    Returns `(alpha_s, fresh_noise_coeff, old_noise_coeff)`, each shaped (batch_size, 1, 1, 1). The chain of small
+    element-wise ops fuses into a single kernel when compiled.
+    """
+    alpha_s = torch.sqrt(1 - var_s)[:, None, None, None]
+    fresh_noise_coeff = ((var_s / var_t).sqrt() * (1 - (1 - var_t) / (1  - var_s)).sqrt())[:, None, None, None]
+    old_noise_coeff = torch.max(var_s[:, None, None, None] - fresh_noise_coeff ** 2, torch.zeros_like(fresh_noise_coeff)).sqrt()
+    return alpha_s, fresh_noise_coeff, old_noise_coeff
+
+
+def stochastic_step(xt, noise_pred, sigma_t, sigma_s, fresh_noise):
+    """One step of the stochastic sampler from `xt` at noise level `sigma_t` to `sigma_s`, given the UNet's `noise_pred`.
+
+    `fresh_noise` may stack several realizations along the batch dimension; they share the deterministic part and
+    the returned `xs` stacks the matching iterates in the same order. Returns `(x0_pred, xs)`. Everything after the
+    UNet call fuses into a couple of kernels when compiled.
+    """
+    x0_pred = ambient_utils.from_noise_pred_to_x0_pred_vp(xt, noise_pred, sigma_t)
+    alpha_s, fresh_noise_coeff, old_noise_coeff = stochastic_step_coeffs(sigma_t ** 2, sigma_s ** 2)
+    deterministic_part = alpha_s * x0_pred + old_noise_coeff * noise_pred
+    num_draws = fresh_noise.shape[0] // xt.shape[0]
+    xs = torch.cat([deterministic_part + fresh_noise_coeff * noise for noise in fresh_noise.chunk(num_draws)])
+    return x0_pred, xs
+
+
+def masked_mse(pred, target, mask):
+    """Squared error averaged over the samples kept by `mask`, matching `get_mean_loss` with a per-sample mask.
+
+    Returns the scalar loss and the per-sample means, which are zero for the masked-out samples.
+    The mask is applied to the (batch_size,) means, so no full-size where/zeros tensors are materialized.
+    """
+    per_sample = (pred.float() - target.float()).square().mean(dim=(1, 2, 3))
+    per_sample = torch.where(mask.bool(), per_sample, torch.zeros_like(per_sample))
+    return per_sample.sum() / mask.sum().clamp_min(1), per_sample
 
 
 
@@ -513,12 +983,17 @@ def main(args):
     logging_dir = Path(args.output_dir, args.logging_dir)
 
     accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
-    kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
+    # Every LoRA parameter is used each step and the sequence of UNet calls is fixed for a run, so DDP can skip
+    # the unused-parameter scan and reuse its buckets. static_graph also allows the repeated UNet calls per backward.
+    kwargs = DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True, gradient_as_bucket_view=True)
+    # The prepared dataloader moves every batch to the device itself; non_blocking makes that copy of the pinned
+    # batches asynchronous (by default it blocks the host until the upload is done)
     accelerator = Accelerator(
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         mixed_precision=args.mixed_precision,
         log_with=args.report_to,
         project_config=accelerator_project_config,
+        dataloader_config=DataLoaderConfiguration(non_blocking=True),
         kwargs_handlers=[kwargs],
     )
 
@@ -567,13 +1042,13 @@ def main(args):
         args.pretrained_model_name_or_path,
         subfolder="tokenizer",
         revision=args.revision,
-        use_fast=False,
+        use_fast=True,
     )
     tokenizer_two = AutoTokenizer.from_pretrained(
         args.pretrained_model_name_or_path,
         subfolder="tokenizer_2",
         revision=args.revision,
-        use_fast=False,
+        use_fast=True,
     )
 
     # import correct text encoder classes
@@ -621,18 +1096,29 @@ def main(args):
     elif accelerator.mixed_precision == "bf16":
         weight_dtype = torch.bfloat16
 
-    # Move unet, vae and text_encoder to device and cast to weight_dtype
+    # Move vae and text_encoder to device and cast to weight_dtype; the unet is moved once its adapter is added.
     # The VAE is in float32 to avoid NaN losses.
-    unet.to(accelerator.device, dtype=weight_dtype)
-
-    if args.pretrained_vae_model_name_or_path is None:
-        vae.to(accelerator.device, dtype=torch.float32)
+    if args.vae_dtype is not None:
+        vae_dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.vae_dtype]
+    elif accelerator.mixed_precision == "bf16":
+        # bf16 has the fp32 exponent range, so the encode does not overflow the way fp16 does
+        vae_dtype = torch.bfloat16
+    elif args.pretrained_vae_model_name_or_path is None:
+        vae_dtype = torch.float32
     else:
-        vae.to(accelerator.device, dtype=weight_dtype)
+        vae_dtype = weight_dtype
+    vae.to(accelerator.device, dtype=vae_dtype)
+    # NHWC lets cuDNN pick the tensor-core conv kernels; the inputs are fed in channels_last as well
+    vae.to(memory_format=torch.channels_last)
+    if args.compile_vae:
+        # Only the encoder runs on fixed shapes here; the pipelines keep calling the eager `vae.decode`.
+        vae.encode = torch.compile(vae.encode, mode="reduce-overhead", dynamic=False)
     text_encoder_one.to(accelerator.device, dtype=weight_dtype)
     text_encoder_two.to(accelerator.device, dtype=weight_dtype)
 
-    if args.enable_xformers_memory_efficient_attention:
+    if args.use_sdpa:
+        unet.set_attn_processor(AttnProcessor2_0())
+    elif args.enable_xformers_memory_efficient_attention:
         if is_xformers_available():
             import xformers
 
@@ -655,6 +1141,7 @@ def main(args):
     )
     print("Adding adapter...")
     unet.add_adapter(unet_lora_config)
+    # A single move of the base weights together with the new LoRA layers
     unet.to(accelerator.device, dtype=weight_dtype)
 
     # The text encoder comes from 🤗 transformers, we will also attach adapters to it.
@@ -669,8 +1156,9 @@ def main(args):
         text_encoder_one.add_adapter(text_lora_config)
         text_encoder_two.add_adapter(text_lora_config)
 
-    # Make sure the trainable params are in float32.
-    if args.mixed_precision == "fp16":
+    # Make sure the trainable params are in float32. This matters for bf16 as well: its 8-bit mantissa would
+    # round small AdamW updates away, while the forward still runs in bf16 under the accelerator's autocast.
+    if args.mixed_precision in ("fp16", "bf16"):
         models = [unet]
         if args.train_text_encoder:
             models.extend([text_encoder_one, text_encoder_two])
@@ -683,6 +1171,18 @@ def main(args):
         model = model._orig_mod if is_compiled_module(model) else model
         return model
 
+    # The hooks only need the model classes; resolve them once instead of unwrapping on every check
+    unet_cls = type(unwrap_model(unet))
+    text_encoder_one_cls = type(unwrap_model(text_encoder_one))
+    text_encoder_two_cls = type(unwrap_model(text_encoder_two))
+
+    # Pair every trainable UNet parameter with its key in the saved LoRA state dict once; neither changes later
+    unet_lora_params = [
+        (param, ("unet." + param_name).replace("lora_A.default", "lora.down").replace("lora_B.default", "lora.up"))
+        for param_name, param in unet.named_parameters()
+        if param.requires_grad
+    ]
+
     # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
     def save_model_hook(models, weights, output_dir):
         if accelerator.is_main_process:
@@ -693,13 +1193,13 @@ def main(args):
             text_encoder_two_lora_layers_to_save = None
 
             for model in models:
-                if isinstance(model, type(unwrap_model(unet))):
+                if isinstance(model, unet_cls):
                     unet_lora_layers_to_save = convert_state_dict_to_diffusers(get_peft_model_state_dict(model))
-                elif isinstance(model, type(unwrap_model(text_encoder_one))):
+                elif isinstance(model, text_encoder_one_cls):
                     text_encoder_one_lora_layers_to_save = convert_state_dict_to_diffusers(
                         get_peft_model_state_dict(model)
                     )
-                elif isinstance(model, type(unwrap_model(text_encoder_two))):
+                elif isinstance(model, text_encoder_two_cls):
                     text_encoder_two_lora_layers_to_save = convert_state_dict_to_diffusers(
                         get_peft_model_state_dict(model)
                     )
@@ -724,32 +1224,34 @@ def main(args):
         while len(models) > 0:
             model = models.pop()
 
-            if isinstance(model, type(unwrap_model(unet))):
+            if isinstance(model, unet_cls):
                 unet_ = model
-            elif isinstance(model, type(unwrap_model(text_encoder_one))):
+            elif isinstance(model, text_encoder_one_cls):
                 text_encoder_one_ = model
-            elif isinstance(model, type(unwrap_model(text_encoder_two))):
+            elif isinstance(model, text_encoder_two_cls):
                 text_encoder_two_ = model
             else:
                 raise ValueError(f"unexpected save model: {model.__class__}")
     
-        unet_params = list(filter(lambda p: p[1].requires_grad, unet_.named_parameters()))
-        
         lora_state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(input_dir)
         # hacky way to load unet params
-        for (param_name, param_value) in unet_params:
-            # keys = list(lora_state_dict.keys())
-            mapped_name = ("unet." + param_name).replace("lora_A.default", "lora.down").replace("lora_B.default", "lora.up")
-            new_param_value = lora_state_dict[mapped_name]
-            param_value.data = new_param_value.to(param_value.data.device).to(param_value.data.dtype)
+        for param_value, mapped_name in unet_lora_params:
+            # copy_ casts to the parameter's device and dtype in place
+            param_value.data.copy_(lora_state_dict[mapped_name])
         # LoraLoaderMixin.load_lora_into_unet(lora_state_dict, network_alphas=network_alphas, unet=unet_)
 
-        text_encoder_state_dict = {k: v for k, v in lora_state_dict.items() if "text_encoder." in k}
+        # Split the text encoder keys by prefix in a single pass over the state dict
+        text_encoder_state_dict, text_encoder_2_state_dict = {}, {}
+        for k, v in lora_state_dict.items():
+            if k.startswith("text_encoder_2."):
+                text_encoder_2_state_dict[k] = v
+            elif k.startswith("text_encoder."):
+                text_encoder_state_dict[k] = v
+
         LoraLoaderMixin.load_lora_into_text_encoder(
             text_encoder_state_dict, network_alphas=network_alphas, text_encoder=text_encoder_one_
         )
 
-        text_encoder_2_state_dict = {k: v for k, v in lora_state_dict.items() if "text_encoder_2." in k}
         LoraLoaderMixin.load_lora_into_text_encoder(
             text_encoder_2_state_dict, network_alphas=network_alphas, text_encoder=text_encoder_two_
         )
@@ -758,16 +1260,41 @@ def main(args):
     accelerator.register_load_state_pre_hook(load_model_hook)
 
     if args.gradient_checkpointing:
+        # diffusers already checkpoints the UNet blocks with use_reentrant=False, which is what torch.compile
+        # supports; request the same for the transformers text encoders
         unet.enable_gradient_checkpointing()
         if args.train_text_encoder:
-            text_encoder_one.gradient_checkpointing_enable()
-            text_encoder_two.gradient_checkpointing_enable()
+            text_encoder_one.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            text_encoder_two.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    # NHWC conv weights, matching the channels_last latents fed in the training loop
+    unet.to(memory_format=torch.channels_last)
+
+    # Compile after the adapter, the fp32 cast of the LoRA params and checkpointing are set up,
+    # so Inductor traces the final module. `unwrap_model` strips the `_orig_mod` wrapper again.
+    if args.compile_unet:
+        unet = torch.compile(unet, mode="reduce-overhead", fullgraph=False, dynamic=False)
+    if args.ac_budget is not None and args.compile_unet:
+        # The min-cut partitioner then saves as much of the compiled graph's activations as the budget allows
+        torch._functorch.config.activation_memory_budget = args.ac_budget
+    encode_prompt_fn = encode_prompt
+    if args.compile_text_encoder and args.train_text_encoder:
+        text_encoder_one = torch.compile(text_encoder_one, mode="reduce-overhead", dynamic=False)
+        text_encoder_two = torch.compile(text_encoder_two, mode="reduce-overhead", dynamic=False)
+    elif args.compile_text_encoder:
+        # Frozen encoders have no autograd graph to break on, so the whole step-time `encode_prompt` is traced and
+        # the hidden-state selection and concat fuse with the encoders' tails. The default mode, since the output
+        # is written into the reused `PROMPT_EMBEDS_BUFFERS` tensor, which CUDA graphs would skip anyway.
+        # The caching map and the validation pipelines keep calling the eager modules.
+        encode_prompt_fn = torch.compile(encode_prompt, dynamic=False)
 
     # Enable TF32 for faster training on Ampere GPUs,
     # cf https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
     if args.allow_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.allow_tf32 = True
+        # Shapes are static (fixed resolution and batch size), so the cuDNN autotuner pays off after the first step
+        torch.backends.cudnn.benchmark = True
 
 
     if args.scale_lr:
@@ -784,24 +1311,32 @@ def main(args):
                 "To use 8-bit Adam, please install the bitsandbytes library: `pip install bitsandbytes`."
             )
 
-        optimizer_class = bnb.optim.AdamW8bit
+        # The paged variant evicts optimizer states to host memory under pressure instead of failing on a spike
+        optimizer_class = bnb.optim.PagedAdamW
+        optimizer_kwargs = {"optim_bits": args.optim_bits}
     else:
         optimizer_class = torch.optim.AdamW
+        # The fused CUDA kernel updates all parameters in a handful of launches instead of a loop of elementwise ops
+        optimizer_kwargs = {"fused": True} if torch.cuda.is_available() else {}
 
     # Optimizer creation
-    params_to_optimize = list(filter(lambda p: p.requires_grad, unet.parameters()))
+    models_params = [unet.parameters()]
     if args.train_text_encoder:
-        params_to_optimize = (
-            params_to_optimize
-            + list(filter(lambda p: p.requires_grad, text_encoder_one.parameters()))
-            + list(filter(lambda p: p.requires_grad, text_encoder_two.parameters()))
-        )
+        models_params.extend([text_encoder_one.parameters(), text_encoder_two.parameters()])
+    params_to_optimize = [p for p in itertools.chain.from_iterable(models_params) if p.requires_grad]
+    # Weight decay only applies to matrices (the LoRA up/down weights); biases and norms, if trainable, are exempt
+    param_groups = [
+        {"params": [p for p in params_to_optimize if p.ndim >= 2], "weight_decay": args.adam_weight_decay},
+        {"params": [p for p in params_to_optimize if p.ndim < 2], "weight_decay": 0.0},
+    ]
+    param_groups = [group for group in param_groups if group["params"]]
     optimizer = optimizer_class(
-        params_to_optimize,
+        param_groups,
         lr=args.learning_rate,
         betas=(args.adam_beta1, args.adam_beta2),
         weight_decay=args.adam_weight_decay,
         eps=args.adam_epsilon,
+        **optimizer_kwargs,
     )
 
     # Get the datasets: you can either provide your own training and evaluation files (see below)
@@ -849,6 +1384,10 @@ def main(args):
             logger.warning(
                 f"--caption_column' value '{args.caption_column}' not found in column_names: {', '.join(column_names)}")
 
+    if isinstance(dataset["train"].features.get(image_column), ImageFeature):
+        # Keep the encoded bytes so `preprocess_train` decodes with torchvision instead of PIL
+        dataset["train"] = dataset["train"].cast_column(image_column, ImageFeature(decode=False))
+
     # Preprocessing the datasets.
     # We need to tokenize input captions and transform the images.
     def tokenize_captions(examples, is_train=True):
@@ -871,91 +1410,233 @@ def main(args):
         return tokens_one, tokens_two
 
     # Preprocessing the datasets.
-    train_resize = transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR)
-    train_crop = transforms.CenterCrop(args.resolution) if args.center_crop else transforms.RandomCrop(args.resolution)
-    train_flip = transforms.RandomHorizontalFlip(p=1.0)
-    train_transforms = transforms.Compose(
+    # The geometric transforms run per image on uint8 tensors (the crop offsets are needed per sample);
+    # the float conversion and normalization run once over the stacked batch.
+    train_resize = v2.Resize(args.resolution, interpolation=v2.InterpolationMode.BILINEAR, antialias=True)
+    train_crop = v2.CenterCrop(args.resolution) if args.center_crop else v2.RandomCrop(args.resolution)
+    train_transforms = v2.Compose(
         [
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize([0.5], [0.5]),
         ]
     )
 
     def preprocess_train(examples):
-        images = [image.convert("RGB") for image in examples[image_column]]
+        images = [decode_image_rgb(image) for image in examples[image_column]]
         # image aug
         original_sizes = []
         all_images = []
         crop_top_lefts = []
-        for image in images:
-            original_sizes.append((image.height, image.width))
+        # All flip decisions at once; the flips themselves run on the stacked batch after cropping
+        flips = torch.rand(len(images)) < 0.5 if args.random_flip else torch.zeros(len(images), dtype=torch.bool)
+        for image, flip in zip(images, flips.tolist()):
+            original_sizes.append(tuple(image.shape[-2:]))
             image = train_resize(image)
-            if args.random_flip and random.random() < 0.5:
-                # flip
-                image = train_flip(image)
+            height, width = image.shape[-2:]
             if args.center_crop:
-                y1 = max(0, int(round((image.height - args.resolution) / 2.0)))
-                x1 = max(0, int(round((image.width - args.resolution) / 2.0)))
+                y1 = max(0, int(round((height - args.resolution) / 2.0)))
+                x1 = max(0, int(round((width - args.resolution) / 2.0)))
                 image = train_crop(image)
             else:
                 y1, x1, h, w = train_crop.get_params(image, (args.resolution, args.resolution))
                 image = crop(image, y1, x1, h, w)
+            if flip:
+                # Flipping the crop equals cropping the flipped image at the mirrored offset, which is the
+                # offset the time ids have always described
+                x1 = width - x1 - args.resolution
             crop_top_left = (y1, x1)
             crop_top_lefts.append(crop_top_left)
-            image = train_transforms(image)
             all_images.append(image)
 
         examples["original_sizes"] = original_sizes
         examples["crop_top_lefts"] = crop_top_lefts
-        examples["pixel_values"] = all_images
-        tokens_one, tokens_two = tokenize_captions(examples)
-        examples["input_ids_one"] = tokens_one
-        examples["input_ids_two"] = tokens_two
+        pixel_values = torch.stack(all_images)
+        if flips.any():
+            pixel_values[flips] = pixel_values[flips].flip(-1)
+        examples["pixel_values"] = list(train_transforms(pixel_values))
+        if "input_ids_one" in examples:
+            # Tokenized once up front by `tokenize_batch`
+            examples["input_ids_one"] = torch.as_tensor(examples["input_ids_one"])
+            examples["input_ids_two"] = torch.as_tensor(examples["input_ids_two"])
+        else:
+            tokens_one, tokens_two = tokenize_captions(examples)
+            examples["input_ids_one"] = tokens_one
+            examples["input_ids_two"] = tokens_two
         return examples
 
+    def tokenize_batch(captions):
+        tokens_one, tokens_two = tokenize_captions({caption_column: captions})
+        # CLIP vocabularies fit in int32, which halves the Arrow columns
+        tokens = {"input_ids_one": tokens_one.to(torch.int32), "input_ids_two": tokens_two.to(torch.int32)}
+        if args.group_by_caption_length:
+            # Up to and including the first end-of-text token; both tokenizers share the CLIP BPE vocabulary,
+            # so the position is the same in both, and everything after it is padding
+            tokens["caption_length"] = (tokens_one == tokenizer_one.eos_token_id).int().argmax(dim=-1) + 1
+        return tokens
+
+    def compute_text_embeddings(input_ids_one, input_ids_two):
+        with torch.no_grad():
+            prompt_embeds, pooled_prompt_embeds = encode_prompt(
+                text_encoders=[text_encoder_one, text_encoder_two],
+                tokenizers=None,
+                prompt=None,
+                text_input_ids_list=[torch.tensor(input_ids_one), torch.tensor(input_ids_two)],
+            )
+        return {"prompt_embeds": prompt_embeds.cpu(), "pooled_prompt_embeds": pooled_prompt_embeds.cpu()}
+
     with accelerator.main_process_first():
+        from datasets.fingerprint import Hasher
+
         if args.max_train_samples is not None:
             dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
+        if caption_column in column_names:
+            # Tokenize every caption once instead of on every read of the training transform.
+            # Only the caption column is read and the image transform is not attached yet, so no image is decoded.
+            # The explicit fingerprint lets the other processes load the tokens from the Arrow cache.
+            new_fingerprint_for_tokens = Hasher.hash(f"tokens_{args.pretrained_model_name_or_path}_{args.revision}_total_samples_{len(dataset['train'])}_caption_column_{caption_column}" + ("_caption_lengths" if args.group_by_caption_length else ""))
+            dataset["train"] = dataset["train"].map(
+                tokenize_batch,
+                input_columns=caption_column,
+                batched=True,
+                batch_size=1000,
+                num_proc=args.dataloader_num_workers or None,
+                new_fingerprint=new_fingerprint_for_tokens,
+            )
+        elif args.group_by_caption_length:
+            raise ValueError("`--group_by_caption_length` needs a caption column to measure.")
+        if args.group_by_caption_length:
+            caption_lengths = dataset["train"]["caption_length"]
+        if args.cache_text_embeddings:
+            logger.info("⏳ Computing text embeddings", main_process_only=True)
+            new_fingerprint_for_text = Hasher.hash(f"text_embeddings_{args.pretrained_model_name_or_path}_{args.revision}_total_samples_{len(dataset['train'])}_caption_column_{caption_column}_dtype_{weight_dtype}")
+            dataset["train"] = dataset["train"].map(
+                compute_text_embeddings,
+                input_columns=["input_ids_one", "input_ids_two"],
+                batched=True,
+                batch_size=args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps,
+                new_fingerprint=new_fingerprint_for_text,
+            )
+            logging.info("We have mapped the text embeddings.")
         # Set the training transforms
         train_dataset = dataset["train"].with_transform(preprocess_train)
 
-    compute_vae_encodings_fn = functools.partial(compute_vae_encodings, vae=vae, noise_scheduler=noise_scheduler)
+    if args.cache_text_embeddings:
+        # The encoders are frozen and no longer needed per step; only the validation pipelines use them
+        text_encoder_one.to("cpu")
+        text_encoder_two.to("cpu")
+        torch.cuda.empty_cache()
+
+    # A seeded generator makes the ambient corruption of the cached latents reproducible across runs
+    vae_noise_generator = None
+    if args.seed is not None:
+        vae_noise_generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
+    # Each map batch is encoded in chunks of `train_batch_size` (a size the VAE is known to fit); holding at least
+    # four of them per map batch keeps the next chunk's upload in flight behind the current encode
+    vae_chunk_size = args.train_batch_size
+    vae_map_batch_size = max(
+        4 * vae_chunk_size, args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
+    )
+    compute_vae_encodings_fn = functools.partial(
+        compute_vae_encodings,
+        vae=vae,
+        noise_scheduler=noise_scheduler,
+        generator=vae_noise_generator,
+        buffers={},
+        chunk_size=vae_chunk_size,
+    )
     logger.info("⏳ Computing vae embeddings", main_process_only=True)
     with accelerator.main_process_first():
         from datasets.fingerprint import Hasher
 
         # fingerprint used by the cache for the other processes to load the result
         # details: https://github.com/huggingface/diffusers/pull/4038#discussion_r1266078401
-        new_fingerprint_for_vae = Hasher.hash(f"vae_noisy_ambient_{args.noisy_ambient}_timestep_nature_{args.timestep_nature}_total_samples_{len(train_dataset)}_resolution_{args.resolution}")
+        new_fingerprint_for_vae = Hasher.hash(f"vae_noisy_ambient_{args.noisy_ambient}_timestep_nature_{args.timestep_nature}_total_samples_{len(train_dataset)}_resolution_{args.resolution}" + ("_flipped" if args.cache_latents and args.random_flip else "") + (f"_text_embeddings_{weight_dtype}" if args.cache_text_embeddings else "") + ("_caption_lengths" if args.group_by_caption_length else ""))
         
         train_dataset = train_dataset.map(
             compute_vae_encodings_fn,
             batched=True,
-            batch_size=args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps,
+            batch_size=vae_map_batch_size,
             new_fingerprint=new_fingerprint_for_vae,
         )
         logging.info("We have mapped the VAE encodings.")
 
+    if args.cache_latents or args.cache_text_embeddings:
+        cached_tensors = {}
+        cached_flipped = {}
+        if args.cache_latents:
+            latents_device = accelerator.device if args.cache_latents_on_gpu else None
+            cached_tensors["model_input"] = load_column_cache(train_dataset, "model_input", device=latents_device)
+            if args.random_flip:
+                cached_flipped["model_input"] = load_column_cache(train_dataset, "model_input_flipped", device=latents_device)
+        if args.cache_text_embeddings:
+            # In the training dtype, so the cached conditioning matches what the per-step encoders would produce
+            cached_tensors["prompt_embeds"] = load_column_cache(train_dataset, "prompt_embeds", dtype=weight_dtype)
+            cached_tensors["pooled_prompt_embeds"] = load_column_cache(
+                train_dataset, "pooled_prompt_embeds", dtype=weight_dtype
+            )
+        cached_columns = list(cached_tensors) + (["model_input_flipped"] if cached_flipped else [])
+        train_dataset = CachedTensorsDataset(train_dataset.remove_columns(cached_columns), cached_tensors, cached_flipped)
+        logging.info(f"Cached {', '.join(cached_tensors)} in memory.")
+
 
 
     def collate_fn(examples):
-        model_input = torch.stack([torch.tensor(example["model_input"]) for example in examples])
-        original_sizes = [example["original_sizes"] for example in examples]
-        crop_top_lefts = [example["crop_top_lefts"] for example in examples]
+        model_input = [example["model_input"] for example in examples]
+        if isinstance(model_input[0], torch.Tensor):
+            # Rows served by `CachedTensorsDataset` are views of one tensor; stacking is the only copy
+            model_input = torch.stack(model_input)
+        else:
+            # Arrow rows arrive as nested lists; convert the whole batch into one contiguous array at once
+            # instead of building a tensor per example and copying them all again in `torch.stack`
+            model_input = torch.from_numpy(np.asarray(model_input, dtype=np.float32))
         input_ids_one = torch.stack([example["input_ids_one"] for example in examples])
         input_ids_two = torch.stack([example["input_ids_two"] for example in examples])
-        return {
+        if args.group_by_caption_length:
+            # The sampler groups similar lengths, so little is left after trimming to the longest caption
+            max_length = max(int(example["caption_length"]) for example in examples)
+            input_ids_one = input_ids_one[:, :max_length]
+            input_ids_two = input_ids_two[:, :max_length]
+        # time ids, adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids:
+        # original size + crop top-left + target size, built as one array for a single host-to-device copy
+        add_time_ids = np.empty((len(examples), 6), dtype=np.float32)
+        for i, example in enumerate(examples):
+            add_time_ids[i, 0:2] = example["original_sizes"]
+            add_time_ids[i, 2:4] = example["crop_top_lefts"]
+        add_time_ids[:, 4:6] = args.resolution
+        batch = {
             "model_input": model_input,
             "input_ids_one": input_ids_one,
             "input_ids_two": input_ids_two,
-            "original_sizes": original_sizes,
-            "crop_top_lefts": crop_top_lefts,
+            "add_time_ids": torch.from_numpy(add_time_ids),
         }
+        if args.cache_text_embeddings:
+            batch["prompt_embeds"] = torch.stack([example["prompt_embeds"] for example in examples])
+            batch["pooled_prompt_embeds"] = torch.stack([example["pooled_prompt_embeds"] for example in examples])
+        return batch
 
     assert len(train_dataset) > 0, "Dataset did not load correctly. Assert path to the dataset is set correctly."
     logging.info("Initializing dataloader...")
     # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(train_dataset, shuffle=True, collate_fn=collate_fn, batch_size=args.train_batch_size, num_workers=args.dataloader_num_workers)
+    # Keep the workers (and their decoded state) alive across epochs and let them run ahead of the GPU;
+    # pinned batches make the host-to-device copies in the training step asynchronous
+    dataloader_kwargs = {}
+    if args.dataloader_num_workers > 0:
+        dataloader_kwargs.update(
+            persistent_workers=True,
+            prefetch_factor=args.dataloader_prefetch_factor,
+            worker_init_fn=dataloader_worker_init_fn,
+        )
+    if args.group_by_caption_length:
+        dataloader_kwargs["batch_sampler"] = CaptionLengthGroupedBatchSampler(caption_lengths, args.train_batch_size)
+    else:
+        dataloader_kwargs.update(shuffle=True, batch_size=args.train_batch_size)
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        collate_fn=collate_fn,
+        num_workers=args.dataloader_num_workers,
+        pin_memory=torch.cuda.is_available() and not args.cache_latents_on_gpu,
+        **dataloader_kwargs,
+    )
     logging.info("Dataloader initialized...")
 
     # Scheduler and math around the number of training steps.
@@ -1108,6 +1789,24 @@ def main(args):
     #epsilon_sigma = 1e-6
     
 
+    # The element-wise chain is launch-bound at these sizes; compiled, it becomes a single fused kernel
+    adjust_timesteps_fn = curriculum_adjust_timesteps
+    if args.compile_step_fns:
+        adjust_timesteps_fn = torch.compile(curriculum_adjust_timesteps, dynamic=False)
+    # Everything the consistency rollout's sampler step does after the UNet call (x0 conversion, coefficients,
+    # composing the iterates); static shapes, so the compiled graph is reused by every rollout step
+    stochastic_step_fn = stochastic_step
+    if args.compile_step_fns:
+        stochastic_step_fn = torch.compile(stochastic_step, fullgraph=True, dynamic=False)
+    # Noise prediction to x_nature prediction in one pointwise pass, without an intermediate x0_pred
+    noise_to_xnature_fn = ambient_utils.from_noise_pred_to_xnature_pred_vp_to_vp
+    if args.compile_step_fns:
+        noise_to_xnature_fn = torch.compile(ambient_utils.from_noise_pred_to_xnature_pred_vp_to_vp, fullgraph=True, dynamic=False)
+    # Subtract, square, mean and masking fuse into a single pass over the latents when compiled
+    masked_mse_fn = masked_mse
+    if args.compile_step_fns:
+        masked_mse_fn = torch.compile(masked_mse, dynamic=False)
+
     def adjust_timesteps(initial_timesteps, loss, min_timesteps, max_timesteps, global_step, max_steps,accelerator):
         """
         Adjust timesteps dynamically based on loss value, incorporating curriculum learning.
@@ -1127,28 +1826,12 @@ def main(args):
         #assert torch.all(loss >= 0.01) and torch.all(loss <= 0.5), f"Loss values out of range: {loss}"
         #assert global_step >= 0 and global_step <= max_steps, f"Global step out of range: {global_step}"
         
-        if torch.any(loss < 0.01) or torch.any(loss > 0.6):
-            loss = torch.clamp(loss, 0.01, 0.6)
-
-        
-
-        # Check normalization
-        loss_normalized = (loss - 0.01) / (0.6 - 0.01)
-        loss_normalized = torch.clamp(loss_normalized, 0.0, 1.0)
-
         # Check curriculum factor
-        curriculum_factor = min(1.0, global_step / (0.2 * max_steps))
-
-        # Check adjustment factor
-        non_linear_factor = torch.tanh((loss_normalized - 0.5) * 10) + 0.5
-        adjustment_factor = (1 - 2 * loss_normalized) * (1 - curriculum_factor) + non_linear_factor * curriculum_factor
-
-        # Check adjustment
-        adjustment = adjustment_factor * (max_timesteps - min_timesteps) * 0.5 * curriculum_factor
-
-        # Ensure clamped timesteps
-        adjusted_timesteps = torch.clamp((initial_timesteps + adjustment).long(), min=min_timesteps, max=max_timesteps)
+        curriculum_factor = torch.full((), min(1.0, global_step / (0.2 * max_steps)), device=loss.device)
 
+        adjusted_timesteps, adjustment_factor, non_linear_factor = adjust_timesteps_fn(
+            initial_timesteps, loss, min_timesteps, max_timesteps, curriculum_factor
+        )
 
         accelerator.log({"adjustment_factor": adjustment_factor, "non_linear_factor": non_linear_factor}, step=global_step)
         
@@ -1156,8 +1839,76 @@ def main(args):
         return adjusted_timesteps
 
 
+    # Device-resident copy of the schedule, kept in fp32 since the sigmas are computed from it
+    alphas_cumprod = noise_scheduler.alphas_cumprod.to(accelerator.device)
+
+    if args.snr_gamma is not None:
+        # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
+        # They only depend on the scheduler, so they are tabulated once per timestep and indexed at step time.
+        # SNR(t) = alphas_cumprod / (1 - alphas_cumprod), the same values `compute_snr` derives per call.
+        snr = alphas_cumprod / (1 - alphas_cumprod)
+        if (args.prediction_type or noise_scheduler.config.prediction_type) == "v_prediction":
+            # Velocity objective requires that we add one to SNR values before we divide by them.
+            snr = snr + 1
+        snr_loss_weights = torch.clamp(snr, max=args.snr_gamma) / snr
+    # Constant nature timesteps; sliced to the batch size, so the last short batch needs no new tensor
+    timesteps_nature = torch.full(
+        (args.train_batch_size,), args.timestep_nature, device=accelerator.device, dtype=torch.long
+    )
+    # sigma(t) = sqrt(1 - alphas_cumprod[t]) for every integer timestep, i.e. what `timesteps_to_sigma` computes
+    # on each call; the step then only gathers from it
+    sigma_table = (1 - alphas_cumprod).sqrt()
+    sigmas_nature = sigma_table.index_select(0, timesteps_nature)
+
+    # The step's Gaussian draws depend only on the batch shape, so they are issued on a side stream where they
+    # overlap the tail of the previous step's backward instead of queueing behind it
+    noise_stream = torch.cuda.Stream(device=accelerator.device) if accelerator.device.type == "cuda" else None
+    # One realization for each of the two loss passes
+    step_noise_buffers = StepNoiseBuffers(2, accelerator.device, weight_dtype, stream=noise_stream)
+
+    validation_pipeline = None
+
+    def get_validation_pipeline():
+        """Build the pipeline for the FID and validation runs on first use and reuse it afterwards.
+
+        It holds the training modules themselves rather than copies, so it always samples with the current LoRA
+        weights; only the tokenizers and the scheduler are loaded from disk, once.
+        """
+        nonlocal validation_pipeline
+        if validation_pipeline is None:
+            validation_pipeline = StableDiffusionXLPipeline.from_pretrained(
+                args.pretrained_model_name_or_path,
+                vae=vae,
+                text_encoder=unwrap_model(text_encoder_one),
+                text_encoder_2=unwrap_model(text_encoder_two),
+                unet=unwrap_model(unet),
+                revision=args.revision,
+                variant=args.variant,
+                torch_dtype=weight_dtype,
+            )
+            validation_pipeline.set_progress_bar_config(disable=True)
+        # Brings back the text encoders that are parked on the CPU when the embeddings are cached
+        return validation_pipeline.to(accelerator.device)
 
-
+    # `accumulate` puts every DDP-wrapped model it is given under `no_sync` on the non-final micro-batches,
+    # so the trained text encoders skip their all-reduce there just like the UNet
+    accumulated_models = [unet]
+    if args.train_text_encoder:
+        accumulated_models.extend([text_encoder_one, text_encoder_two])
+
+    # Eager selective checkpointing of the rollout; compiled UNets follow the partitioner's budget instead
+    rollout_checkpoint_kwargs = {}
+    if args.ac_budget and not args.compile_unet:
+        rollout_checkpoint_kwargs["context_fn"] = make_rollout_checkpoint_context_fn()
+
+    # Checkpoint names are tracked in memory so a save does not rescan the output dir, and old checkpoints
+    # are deleted on a background thread while the next steps run
+    checkpoint_queue = None
+    checkpoint_remover = None
+    if accelerator.is_main_process and args.checkpoints_total_limit is not None:
+        existing_checkpoints = [d for d in os.listdir(args.output_dir) if d.startswith("checkpoint")]
+        checkpoint_queue = collections.deque(sorted(existing_checkpoints, key=lambda x: int(x.split("-")[1])))
+        checkpoint_remover = ThreadPoolExecutor(max_workers=1)
 
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
@@ -1173,15 +1924,23 @@ def main(args):
                 logger.info("Time limit reached. Exiting.")
                 import sys; sys.exit(0)
 
-            with accelerator.accumulate(unet):
-                model_input = batch["model_input"].to(accelerator.device, dtype=weight_dtype)
-                # Sample noise that we'll add to the latents
-                noise = torch.randn_like(model_input)
-                if args.noise_offset:
-                    # https://www.crosslabs.org//blog/diffusion-with-offset-noise
-                    noise += args.noise_offset * torch.randn(
-                        (model_input.shape[0], model_input.shape[1], 1, 1), device=model_input.device
-                    )
+            if args.compile_unet or args.compile_text_encoder:
+                # reduce-overhead graphs are CUDA graphs: a new step may reuse the previous step's output memory.
+                # Every UNet call of the step (both loss passes, the rollouts and `preds_prime_*`) runs through
+                # the same compiled module, so its outputs stay valid until the next one of these marks.
+                torch.compiler.cudagraph_mark_step_begin()
+
+            with accelerator.accumulate(*accumulated_models):
+                # accelerate already uploaded the batch without blocking the host (see `dataloader_config`), so these
+                # calls only cast the dtype and set the layout; non_blocking keeps them asynchronous should they copy
+                model_input = batch["model_input"].to(
+                    accelerator.device, dtype=weight_dtype, memory_format=torch.channels_last, non_blocking=True
+                )
+                # Sample noise that we'll add to the latents; queued after the upload so it does not wait on it
+                step_noise = step_noise_buffers.draw(
+                    model_input.shape, noise_offset=0 if args.noisy_ambient else args.noise_offset
+                )
+                noise = step_noise[0]
                 
 
                 """
@@ -1213,40 +1972,41 @@ def main(args):
                 # Add noise to the model input according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
                 if args.noisy_ambient:
-                    desired_sigmas, noise_gain_desired = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps, noise_scheduler.alphas_cumprod.to(timesteps.device))
-                    current_sigmas, noise_gain_current = ambient_utils.diffusers_utils.timesteps_to_sigma(torch.ones_like(timesteps) * args.timestep_nature, noise_scheduler.alphas_cumprod.to(timesteps.device))
+                    desired_sigmas = sigma_table.index_select(0, timesteps)
+                    current_sigmas = sigmas_nature[:bsz]
 
                     #desired_sigmas, noise_gain_desired = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps, noise_scheduler.alphas_cumprod.to(timesteps.device), loss=previous_loss)
                     #current_sigmas, noise_gain_current = ambient_utils.diffusers_utils.timesteps_to_sigma(torch.ones_like(timesteps) * args.timestep_nature, noise_scheduler.alphas_cumprod.to(timesteps.device), loss=previous_loss)
 
                     #desired_sigmas = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps, noise_scheduler.alphas_cumprod.to(timesteps.device))
                     #current_sigmas = ambient_utils.diffusers_utils.timesteps_to_sigma(torch.ones_like(timesteps) * args.timestep_nature, noise_scheduler.alphas_cumprod.to(timesteps.device))                    
-                    noisy_model_input, noise_realization, noise_mask = ambient_utils.add_extra_noise_from_vp_to_vp(model_input, current_sigmas, desired_sigmas)
+                    noisy_model_input, noise_realization, noise_mask = ambient_utils.add_extra_noise_from_vp_to_vp(
+                        model_input, current_sigmas, desired_sigmas, noise_realization=step_noise[0]
+                    )
                 else:
                     noisy_model_input = noise_scheduler.add_noise(model_input, adjusted_noise, timesteps)
                     noise_mask = torch.ones(noisy_model_input.shape[0], device=noisy_model_input.device, dtype=torch.long)
+                # Broadcast (bsz, 1, 1, 1) coefficients do not pin the output layout; keep the UNet input NHWC
+                # (a no-op when the element-wise ops already preserved it)
+                noisy_model_input = noisy_model_input.contiguous(memory_format=torch.channels_last)
 
                 # time ids
-                def compute_time_ids(original_size, crops_coords_top_left):
-                    # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
-                    target_size = (args.resolution, args.resolution)
-                    add_time_ids = list(original_size + crops_coords_top_left + target_size)
-                    add_time_ids = torch.tensor([add_time_ids])
-                    add_time_ids = add_time_ids.to(accelerator.device, dtype=weight_dtype)
-                    return add_time_ids
-
-                add_time_ids = torch.cat(
-                    [compute_time_ids(s, c) for s, c in zip(batch["original_sizes"], batch["crop_top_lefts"])]
-                )
+                add_time_ids = batch["add_time_ids"].to(accelerator.device, dtype=weight_dtype, non_blocking=True)
 
                 # Predict the noise residual
                 unet_added_conditions = {"time_ids": add_time_ids}
-                prompt_embeds, pooled_prompt_embeds = encode_prompt(
-                    text_encoders=[text_encoder_one, text_encoder_two],
-                    tokenizers=None,
-                    prompt=None,
-                    text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
-                )
+                if args.cache_text_embeddings:
+                    prompt_embeds = batch["prompt_embeds"].to(accelerator.device, dtype=weight_dtype, non_blocking=True)
+                    pooled_prompt_embeds = batch["pooled_prompt_embeds"].to(
+                        accelerator.device, dtype=weight_dtype, non_blocking=True
+                    )
+                else:
+                    prompt_embeds, pooled_prompt_embeds = encode_prompt_fn(
+                        text_encoders=[text_encoder_one, text_encoder_two],
+                        tokenizers=None,
+                        prompt=None,
+                        text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
+                    )
                 unet_added_conditions.update({"text_embeds": pooled_prompt_embeds})
                 model_pred = unet(
                     noisy_model_input,
@@ -1271,8 +2031,7 @@ def main(args):
                 else:
                     assert noise_scheduler.config.prediction_type == "epsilon", "Only epsilon prediction type is supported for noisy ambient"
                     # the model outputs the noise to the clean image. We can use that to predict the clean image itself.
-                    x0_pred = ambient_utils.from_noise_pred_to_x0_pred_vp(noisy_model_input, model_pred, desired_sigmas)
-                    xn_pred = ambient_utils.from_x0_pred_to_xnature_pred_vp_to_vp(x0_pred, noisy_model_input, current_sigmas, desired_sigmas)
+                    xn_pred = noise_to_xnature_fn(noisy_model_input, model_pred, current_sigmas, desired_sigmas)
 
                     if args.x0_pred:
                         model_pred = xn_pred
@@ -1286,39 +2045,15 @@ def main(args):
 
                 if args.snr_gamma is None:
                     # This is what we are using
-                    first_loss = (model_pred.float() - target.float()) ** 2                    
-                    first_loss = torch.where(noise_mask[:, None, None, None] == 0, torch.zeros_like(first_loss), first_loss)
-
-                    if noise_mask is None:
-                        # Average loss across channels, height, and width for each batch sample
-                        loss_per_sample = first_loss.mean(dim=(1, 2, 3)).detach()
-                    else:
-                        if len(noise_mask.shape) == 1:
-                            # Expand mask to match the loss tensor
-                            noise_mask_tmp = noise_mask[:, None, None, None].expand_as(first_loss)
-
-                        # Avoid division by zero when mask.sum(dim=(1, 2, 3)) is 0
-                        mask_sum_per_sample = noise_mask_tmp.sum(dim=(1, 2, 3))
-                        mask_sum_per_sample[mask_sum_per_sample == 0] = 1  # Replace 0 with 1 to avoid division errors
-
-                        # Compute the loss for each sample, considering the mask
-                        loss_per_sample = ((first_loss * noise_mask_tmp).sum(dim=(1, 2, 3)) / mask_sum_per_sample).detach()
-
-
-                    first_loss = ambient_utils.get_mean_loss(first_loss, noise_mask)
+                    first_loss, loss_per_sample = masked_mse_fn(model_pred, target, noise_mask)
+                    loss_per_sample = loss_per_sample.detach()
 
                 else:
                     assert not args.noisy_ambient, "SNR weighting is not supported for noisy ambient"
-                    # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
+                    # Loss-weights from the precomputed table (Section 3.4 of https://arxiv.org/abs/2303.09556).
                     # Since we predict the noise instead of x_0, the original formulation is slightly changed.
                     # This is discussed in Section 4.2 of the same paper.
-                    snr = compute_snr(noise_scheduler, timesteps)
-                    if noise_scheduler.config.prediction_type == "v_prediction":
-                        # Velocity objective requires that we add one to SNR values before we divide by them.
-                        snr = snr + 1
-                    mse_loss_weights = (
-                        torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
-                    )
+                    mse_loss_weights = snr_loss_weights.index_select(0, timesteps)
 
                     first_loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
                     first_loss = first_loss.mean(dim=list(range(1, len(first_loss.shape)))) * mse_loss_weights
@@ -1337,10 +2072,13 @@ def main(args):
                 # =======================================================
                 # Second loss calculation based on the ajusted timesteps
                 # =======================================================
-                desired_sigmas, noise_gain_desired = ambient_utils.diffusers_utils.timesteps_to_sigma(adjusted_timesteps, noise_scheduler.alphas_cumprod.to(model_input.device))
-                current_sigmas, noise_gain_current = ambient_utils.diffusers_utils.timesteps_to_sigma(torch.ones_like(adjusted_timesteps) * args.timestep_nature, noise_scheduler.alphas_cumprod.to(model_input.device))
-                noisy_model_input, noise_realization, noise_mask = ambient_utils.add_extra_noise_from_vp_to_vp(model_input, current_sigmas, desired_sigmas)
-                model_pred = unet(
+                desired_sigmas = sigma_table.index_select(0, adjusted_timesteps)
+                current_sigmas = sigmas_nature[:bsz]
+                noisy_model_input, noise_realization, noise_mask = ambient_utils.add_extra_noise_from_vp_to_vp(
+                    model_input, current_sigmas, desired_sigmas, noise_realization=step_noise[1]
+                )
+                noisy_model_input = noisy_model_input.contiguous(memory_format=torch.channels_last)
+                noise_pred = unet(
                     noisy_model_input,
                     adjusted_timesteps,
                     prompt_embeds,
@@ -1348,13 +2086,10 @@ def main(args):
                     return_dict=False,
                 )[0]
 
-                x0_pred = ambient_utils.from_noise_pred_to_x0_pred_vp(noisy_model_input, model_pred, desired_sigmas)
-                xn_pred = ambient_utils.from_x0_pred_to_xnature_pred_vp_to_vp(x0_pred, noisy_model_input, current_sigmas, desired_sigmas)
+                xn_pred = noise_to_xnature_fn(noisy_model_input, noise_pred, current_sigmas, desired_sigmas)
                 model_pred = xn_pred
                 target = model_input
-                loss = (model_pred.float() - target.float()) ** 2                    
-                loss = torch.where(noise_mask[:, None, None, None] == 0, torch.zeros_like(loss), loss)
-                loss = ambient_utils.get_mean_loss(loss, noise_mask)
+                loss, _ = masked_mse_fn(model_pred, target, noise_mask)
 
                 
                 # ==========================================================
@@ -1371,89 +2106,109 @@ def main(args):
                     else:
                         # compute values at the boundary
                         xt = model_input
-                        timesteps_xt = torch.ones_like(timesteps) * args.timestep_nature
-
-
-                    def move_one_step(xt, timesteps_xt, timesteps_xs=None):
-                        sigma_t = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps_xt, noise_scheduler.alphas_cumprod.to(timesteps.device))
-                        var_t = sigma_t ** 2
-                        noise_pred_xt = unet(xt, timesteps_xt, prompt_embeds, added_cond_kwargs=unet_added_conditions, return_dict=False)[0]
-                        x0_pred = ambient_utils.from_noise_pred_to_x0_pred_vp(xt, noise_pred_xt, sigma_t)
+                        timesteps_xt = timesteps_nature[:bsz]
+
+
+                    def move_one_step(
+                        xt,
+                        timesteps_xt,
+                        timesteps_xs=None,
+                        with_alt=False,
+                        encoder_hidden_states=prompt_embeds,
+                        added_cond_kwargs=unet_added_conditions,
+                        sigma_table=sigma_table,
+                    ):
+                        sigma_t = sigma_table.index_select(0, timesteps_xt)
+                        # Queued on the noise stream, so the fill runs alongside the UNet forward below;
+                        # with `with_alt` both fresh noises come from this one draw
+                        fresh_noise = randn_channels_last(
+                            ((2 if with_alt else 1) * xt.shape[0], *xt.shape[1:]), xt.device, xt.dtype, stream=noise_stream
+                        )
+                        if args.checkpoint_rollout and torch.is_grad_enabled():
+                            # Only the inputs of each rollout forward are kept; everything inside the UNet is
+                            # recomputed in the backward pass. The `preds_prime_*` forwards stay uncheckpointed.
+                            noise_pred_xt = torch.utils.checkpoint.checkpoint(
+                                lambda x, t: unet(x, t, encoder_hidden_states, added_cond_kwargs=added_cond_kwargs, return_dict=False)[0],
+                                xt,
+                                timesteps_xt,
+                                use_reentrant=False,
+                                **rollout_checkpoint_kwargs,
+                            )
+                        else:
+                            noise_pred_xt = unet(xt, timesteps_xt, encoder_hidden_states, added_cond_kwargs=added_cond_kwargs, return_dict=False)[0]
 
                         if timesteps_xs is None:
                             # select different timesteps in [timesteps_xt - args.max_steps_diff, timesteps_xt]
-                            steps_diffs = torch.randint(1, args.max_steps_diff + 1, (bsz,), device=timesteps_xt.device)
+                            steps_diffs = torch.randint(1, args.max_steps_diff + 1, timesteps_xt.shape, device=timesteps_xt.device)
                             timesteps_xs = torch.max(torch.zeros_like(timesteps_xt), timesteps_xt - steps_diffs)
 
-                        sigma_s = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps_xs, noise_scheduler.alphas_cumprod.to(timesteps_xt.device))
-                        var_s = sigma_s ** 2
-                        alpha_s = torch.sqrt(1 - var_s)[:, None, None, None]
+                        sigma_s = sigma_table.index_select(0, timesteps_xs)
+                        if noise_stream is not None:
+                            torch.cuda.current_stream(xt.device).wait_stream(noise_stream)
+
+                        # Move there with the (1 step) stochastic sampler, once per fresh noise; with `with_alt`
+                        # `xs` holds both iterates, batched as the rest of the rollout runs them
+                        x0_pred, xs = stochastic_step_fn(xt, noise_pred_xt, sigma_t, sigma_s, fresh_noise)
 
-                        # Move there two times with (1 step) stochastic sampler
-                        fresh_noise_coeff = ((var_s / var_t).sqrt() * (1 - (1 - var_t) / (1  - var_s)).sqrt())[:, None, None, None]
-                        old_noise_coeff = torch.max(var_s[:, None, None, None] - fresh_noise_coeff ** 2, torch.zeros_like(fresh_noise_coeff)).sqrt()
-                        
                         return_dict = {
-                            "xs": alpha_s * x0_pred + old_noise_coeff * noise_pred_xt + fresh_noise_coeff * torch.randn_like(x0_pred),
-                            "xs_alt": alpha_s * x0_pred + old_noise_coeff * noise_pred_xt + fresh_noise_coeff * torch.randn_like(x0_pred),
+                            "xs": xs,
                             "timesteps_xs": timesteps_xs,
                             "x0_pred": x0_pred,
                         }
                         return return_dict
                     
+                    # The two iterates run as one 2 * bsz batch after their shared first step
+                    prompt_embeds_2x = prompt_embeds.repeat(2, 1, 1)
+                    unet_added_conditions_2x = {
+                        k: v.repeat(2, *([1] * (v.ndim - 1))) for k, v in unet_added_conditions.items()
+                    }
                     with torch.set_grad_enabled(args.with_grad):
-                        x_curr = torch.clone(xt)
-                        t_curr = torch.clone(timesteps_xt)
-                        used_timesteps = []
-                        # move first iterate                        
-                        for i in range(args.num_consistency_steps):
-                            return_dict = move_one_step(x_curr, t_curr)
-                            if i == 0:
-                                # keep prediction at the boundary
-                                x0_pred = return_dict["x0_pred"]
-                            t_curr = return_dict["timesteps_xs"]
-                            used_timesteps.append(t_curr)
+                        # Both iterates start from xt, so their first step shares one UNet call and differs only
+                        # in the fresh noise; keep the prediction at the boundary from it
+                        return_dict = move_one_step(xt, timesteps_xt, with_alt=True)
+                        x0_pred = return_dict["x0_pred"]
+                        t_curr = return_dict["timesteps_xs"]
+                        x_curr = return_dict["xs"]
+                    if args.detach_rollout:
+                        x_curr = x_curr.detach()
+                    # Only the remaining steps drop the tape under `--detach_rollout`; the boundary x0_pred above keeps it
+                    with torch.set_grad_enabled(args.with_grad and not args.detach_rollout):
+                        for i in range(1, args.num_consistency_steps):
+                            steps_diffs = torch.randint(1, args.max_steps_diff + 1, (bsz,), device=t_curr.device)
+                            t_next = torch.max(torch.zeros_like(t_curr), t_curr - steps_diffs)
+                            return_dict = move_one_step(
+                                x_curr,
+                                t_curr.repeat(2),
+                                t_next.repeat(2),
+                                encoder_hidden_states=prompt_embeds_2x,
+                                added_cond_kwargs=unet_added_conditions_2x,
+                            )
+                            t_curr = t_next
                             x_curr = return_dict["xs"]
-                        
-                        x_t_prime_1 = x_curr
-                        if args.num_consistency_steps == 1:
-                            # save time and memory
-                            x_curr = return_dict["xs_alt"]
-                            t_curr = return_dict["timesteps_xs"]
-                        else:
-                            x_curr = torch.clone(xt)
-                            t_curr = torch.clone(timesteps_xt)
-                            # move second iterate
-                            for i in range(args.num_consistency_steps):
-                                return_dict = move_one_step(x_curr, t_curr, used_timesteps[i])
-                                t_curr = return_dict["timesteps_xs"]
-                                x_curr = return_dict["xs"]
-
-                    x_t_prime_2 = x_curr
-                    timesteps_xs = t_curr                            
-                    sigma_s = ambient_utils.diffusers_utils.timesteps_to_sigma(timesteps_xs, noise_scheduler.alphas_cumprod.to(timesteps.device))
+
+                    timesteps_xs = t_curr
+                    sigma_s = sigma_table.index_select(0, timesteps_xs)
                     
-                    # Predict at the new timesteps
-                    preds_prime_1 = unet(x_t_prime_1, timesteps_xs, prompt_embeds, added_cond_kwargs=unet_added_conditions, return_dict=False)[0]
-                    preds_prime_2 = unet(x_t_prime_2, timesteps_xs, prompt_embeds, added_cond_kwargs=unet_added_conditions, return_dict=False)[0]
+                    # Predict at the new timesteps, both iterates in one call
+                    preds_prime = unet(x_curr, timesteps_xs.repeat(2), prompt_embeds_2x, added_cond_kwargs=unet_added_conditions_2x, return_dict=False)[0]
 
                     # from noise_pred to x0_pred
-                    preds_prime_1 = ambient_utils.from_noise_pred_to_x0_pred_vp(x_t_prime_1, preds_prime_1, sigma_s)
-                    preds_prime_2 = ambient_utils.from_noise_pred_to_x0_pred_vp(x_t_prime_2, preds_prime_2, sigma_s)
+                    preds_prime = ambient_utils.from_noise_pred_to_x0_pred_vp(x_curr, preds_prime, sigma_s.repeat(2))
+                    preds_prime_1, preds_prime_2 = preds_prime.chunk(2)
                     
                     consistency_loss = (preds_prime_1 - x0_pred) * (preds_prime_2 - x0_pred)
                     consistency_loss = consistency_loss.mean()
+                    # masked_mse already returns a scalar, so the sum needs no further reduction
                     loss += args.consistency_coeff * consistency_loss
-                    loss = loss.mean()
-                else:
-                    consistency_loss = torch.tensor(0.0, device=loss.device)
+                    assert loss.dim() == 0, f"Expected a scalar loss, got shape {tuple(loss.shape)}"
 
-                # Gather the losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
-                train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                    avg_consistency_loss = accelerator.gather(consistency_loss.detach().repeat(args.train_batch_size)).mean()
+                    consistency_train_loss += avg_consistency_loss / args.gradient_accumulation_steps
 
-                avg_consistency_loss = accelerator.gather(consistency_loss.repeat(args.train_batch_size)).mean()
-                consistency_train_loss += avg_consistency_loss.item() / args.gradient_accumulation_steps
+                # Gather the losses across all processes for logging (if we use distributed training).
+                # The running sums stay on the device and are only synced (float()) where they are logged.
+                avg_loss = accelerator.gather(loss.detach().repeat(args.train_batch_size)).mean()
+                train_loss += avg_loss / args.gradient_accumulation_steps
 
                 # Backpropagate
                 accelerator.backward(loss)
@@ -1462,7 +2217,7 @@ def main(args):
 
                 optimizer.step()
                 lr_scheduler.step()
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
                 # useful for visualizing what happens before taking any gradients
                 if epoch == first_epoch and args.skip_first_epoch:
@@ -1473,7 +2228,7 @@ def main(args):
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
-                #accelerator.log({"train_loss": train_loss}, step=global_step)
+                #accelerator.log({"train_loss": float(train_loss)}, step=global_step)
                 
                 """
                 # Log the two curves
@@ -1487,66 +2242,53 @@ def main(args):
                     "adjusted_timesteps_curve_b2": adjusted_timesteps[1]
                 }, step=global_step)
                 """
-                #accelerator.log({"consistency_train_loss": consistency_train_loss}, step=global_step)
+                #accelerator.log({"consistency_train_loss": float(consistency_train_loss)}, step=global_step)
                 train_loss = 0.0
                 consistency_train_loss = 0.0
 
                 if accelerator.is_main_process:
                     if global_step % args.checkpointing_steps == 0:
                         # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                        if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                            checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
-
+                        if checkpoint_queue is not None:
                             # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                            if len(checkpoints) >= args.checkpoints_total_limit:
-                                num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
-                                removing_checkpoints = checkpoints[0:num_to_remove]
+                            removing_checkpoints = []
+                            while checkpoint_queue and len(checkpoint_queue) >= args.checkpoints_total_limit:
+                                removing_checkpoints.append(checkpoint_queue.popleft())
 
+                            if removing_checkpoints:
                                 logger.info(
-                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
+                                    f"{len(checkpoint_queue) + len(removing_checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
                                 )
                                 logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
 
                                 for removing_checkpoint in removing_checkpoints:
                                     removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
-                                    shutil.rmtree(removing_checkpoint)
+                                    checkpoint_remover.submit(shutil.rmtree, removing_checkpoint, ignore_errors=True)
 
                         save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
                         accelerator.save_state(save_path)
                         logger.info(f"Saved state to {save_path}")
+                        if checkpoint_queue is not None:
+                            checkpoint_queue.append(os.path.basename(save_path))
                 # compute FID
                 #accelerator.print("global_step = {global_step}")
                 if (global_step % args.FID_step_num == 0 or global_step <= 1) and args.track_fid:    
                     with torch.no_grad():
                         
                         accelerator.print("FID computation starts at step {global_step}...")
-                        pipeline = StableDiffusionXLPipeline.from_pretrained(
-                            args.pretrained_model_name_or_path,
-                            vae=vae,
-                            text_encoder=unwrap_model(text_encoder_one),
-                            text_encoder_2=unwrap_model(text_encoder_two),
-                            unet=unwrap_model(unet),
-                            revision=args.revision,
-                            variant=args.variant,
-                            torch_dtype=weight_dtype,
-                        )
-                        pipeline = pipeline.to(accelerator.device)
-                        pipeline.set_progress_bar_config(disable=True)
+                        pipeline = get_validation_pipeline()
 
                         accelerator.print(f"Computing FID score with {args.num_images_for_fid} images...")
                         gen_images(pipeline, None, log_under="validation_fid", num_validation_images=args.num_images_for_fid, track_images=False)
                         accelerator.print(f"Generated {args.num_images_for_fid} images for FID computation.")
                         if accelerator.is_main_process:
                             accelerator.print("Calculating inception stats")
+                            # The Inception detector is loaded on the first call and kept for the following ones
                             mu, sigma, inception = calculate_inception_stats(image_path=os.path.join(args.output_dir, "validation_images", str(global_step)), 
-                                                                            num_expected=args.num_images_for_fid, seed=42, max_batch_size=1, 
-                                                                            distributed=False,num_workers=1)
+                                                                            num_expected=args.num_images_for_fid, seed=42, max_batch_size=64, 
+                                                                            distributed=False)
                             accelerator.print("Inception stats calculated.")
-                            ref_data = np.load(args.fid_ref_path)
-                            ref_mu = ref_data['mu']
-                            ref_sigma = ref_data['sigma']
+                            ref_mu, ref_sigma = load_fid_ref_stats(args.fid_ref_path)
                             #accelerator.print("ref_mu shape:", ref_mu.shape)
                             #accelerator.print("ref_sigma shape:", ref_sigma.shape)
                             #accelerator.print("mu shape:", mu.shape)
@@ -1554,38 +2296,19 @@ def main(args):
                             fid = calculate_fid_from_inception_stats(mu, sigma, ref_mu,ref_sigma)
                             accelerator.log({"fid": fid, "inception": inception}, step=global_step)
 
-                        del pipeline
+                        if args.cache_text_embeddings:
+                            # pipeline.to() moved the text encoders back onto the GPU
+                            text_encoder_one.to("cpu")
+                            text_encoder_two.to("cpu")
+                        # Release the sampling and Inception scratch memory; the training step reuses its cached blocks
+                        torch.cuda.empty_cache()
                         accelerator.print("FID computation finished...")
 
                 # generate images for validation
                 if (global_step % args.validation_step_num == 0 or global_step < 64) and args.track_val:
                     if accelerator.is_main_process and args.validation_prompt is not None:
                         logger.info(f"\n \tRunning validation at step {global_step}...")
-                        # create pipeline
-                    pipeline = StableDiffusionXLPipeline.from_pretrained(
-                        args.pretrained_model_name_or_path,
-                        vae=vae,
-                        text_encoder=unwrap_model(text_encoder_one),
-                        text_encoder_2=unwrap_model(text_encoder_two),
-                        unet=unwrap_model(unet),
-                        revision=args.revision,
-                        variant=args.variant,
-                        torch_dtype=weight_dtype,
-                    )
-                    # Load the pipeline with explicit configuration settings
-                    pipeline = StableDiffusionXLPipeline.from_pretrained(
-                        args.pretrained_model_name_or_path,
-                        vae=vae,
-                        text_encoder=unwrap_model(text_encoder_one),
-                        text_encoder_2=unwrap_model(text_encoder_two),
-                        unet=unwrap_model(unet),
-                        revision=args.revision,
-                        variant=args.variant,
-                        torch_dtype=weight_dtype,
-                    )
-
-                    pipeline = pipeline.to(accelerator.device)
-                    pipeline.set_progress_bar_config(disable=True)
+                    pipeline = get_validation_pipeline()
                     with torch.no_grad():
                         accelerator.print("Generating images, early stopped.")
                         gen_images(pipeline, pipe_stop_index, log_under="validation_early_stopped", distributed=False)
@@ -1593,7 +2316,10 @@ def main(args):
                         #gen_images(pipeline, None, log_under="validation_full", distributed=False)
             
 
-                    del pipeline
+                    if args.cache_text_embeddings:
+                        # pipeline.to() moved the text encoders back onto the GPU
+                        text_encoder_one.to("cpu")
+                        text_encoder_two.to("cpu")
                     """
                     ambient_utils.save_images(torch.cat([model_input, noisy_model_input, x0_pred]), 
                                               os.path.join(args.output_dir, "l_nature|l_input|l_red.png"), num_rows=3, 
@@ -1601,14 +2327,18 @@ def main(args):
                     """
                     accelerator.print("Decoding images...")
                     with torch.no_grad():
-                        dec_model_input = vae.decode(model_input.to(vae.dtype) / vae.config.scaling_factor).sample
-                        dec_noisy_model_input = vae.decode(noisy_model_input.to(vae.dtype) / vae.config.scaling_factor).sample
-                        dec_x0_pred = vae.decode(x0_pred.to(vae.dtype) / vae.config.scaling_factor).sample
-                    del model_input, noisy_model_input, x0_pred    
-                    ambient_utils.save_images(torch.cat([dec_model_input, dec_noisy_model_input, dec_x0_pred]), 
+                        # The loss heads no longer form x0_pred, so it is rebuilt here from the second pass
+                        x0_pred = ambient_utils.from_noise_pred_to_x0_pred_vp(noisy_model_input, noise_pred, desired_sigmas)
+                        # One decode over the three stacked latents streams the decoder weights once instead of
+                        # three times; the rows come out in the same order as the three separate decodes did
+                        latents = torch.cat([model_input, noisy_model_input, x0_pred]).to(vae.dtype) / vae.config.scaling_factor
+                        decoded = vae.decode(latents.contiguous(memory_format=torch.channels_last)).sample
+                    del model_input, noisy_model_input, x0_pred, latents
+                    ambient_utils.save_images(decoded, 
                                               os.path.join(args.output_dir, "dec_nature|dec_input|dec_pred.png"), num_rows=3,
                                               save_wandb=True if args.report_to == "wandb" else False)
-                    del dec_model_input, dec_noisy_model_input, dec_x0_pred
+                    del decoded
+                    torch.cuda.empty_cache()
                     accelerator.print("Finished decoding...")
                     
                     
@@ -1618,7 +2348,6 @@ def main(args):
             accelerator.log({"second loss": loss}, step=global_step)
             accelerator.log({"timesteps": timesteps}, step=global_step)
             accelerator.log({"adjusted timesteps": adjusted_timesteps}, step=global_step)
-            torch.cuda.empty_cache()
             logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
 
@@ -1628,6 +2357,10 @@ def main(args):
 
 
 
+    # Let pending checkpoint removals finish before the final save
+    if checkpoint_remover is not None:
+        checkpoint_remover.shutdown(wait=True)
+
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -1679,6 +2412,9 @@ def main(args):
 if __name__ == "__main__":
     # Suppress specific warnings if they are harmless
     warnings.filterwarnings("ignore", message=r".*was not found in config.*")
+    # Read at the first CUDA allocation: growable segments let the allocator reuse the memory freed when the
+    # FID/validation pipelines are torn down without an explicit flush. An explicit setting takes precedence.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 
     args = parse_args()
     main(args)